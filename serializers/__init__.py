@@ -1,6 +1,7 @@
 from serializers.serializer import (
     Serializer,
     ModelSerializer,
+    warm_up,
 )
 from serializers.fields import (
     Field,
@@ -3,12 +3,16 @@ from django.utils.encoding import is_protected_type, smart_unicode
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ManyToManyField, OneToOneField
+from django.db.models.query import prefetch_one_level, prefetch_related_objects
+from django.db.models.sql.constants import LOOKUP_SEP
 from django.db.models.related import RelatedObject
 from django.utils import timezone
 from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import ugettext_lazy as _
-from serializers.utils import is_simple_callable
+from serializers.utils import DeferredValue, is_simple_callable
 import warnings
 
 
@@ -78,6 +82,17 @@ class Field(object):
 
         return self.to_native(getattr(obj, self.source or field_name))
 
+    def field_to_native_batch(self, objs, field_name):
+        """
+        Given a list of objects and a field name, returns a list of the
+        values that should be serialized for that field, one per object.
+
+        Serializers call this once for each chunk of objects, so fields
+        can compute their values together, eg. with a single aggregate
+        query.  Return None to use `field_to_native` for each object.
+        """
+        return None
+
     def to_native(self, value):
         """
         Converts the field's value into it's simple representation.
@@ -85,12 +100,32 @@ class Field(object):
         if is_simple_callable(value):
             value = value()
 
-        if is_protected_type(value):
+        if isinstance(value, DeferredValue):
+            return value.then(self.to_native)
+        elif is_protected_type(value):
             return value
         elif hasattr(self, 'model_field'):
             return self.model_field.value_to_string(self.obj)
         return smart_unicode(value)
 
+    def required_columns(self, obj, field_name):
+        """
+        Returns the names of the model fields that must be loaded from the
+        database in order to serialize this field, or None if that can't
+        be determined.
+        """
+        if self.source == '*':
+            return None
+        model_field = getattr(self, 'model_field', None)
+        if model_field is None:
+            try:
+                model_field = obj._meta.get_field_by_name(self.source or field_name)[0]
+            except (AttributeError, FieldDoesNotExist):
+                return None  # Not a model field, eg. a method or property
+        if isinstance(model_field, (RelatedObject, ManyToManyField)):
+            return []  # Loaded with a separate query
+        return [model_field.name]
+
     def attributes(self):
         """
         Returns a dictionary of attributes to be used when serializing to xml.
@@ -109,14 +144,99 @@ class RelatedField(Field):
 
     Subclass this and override `convert` to define custom behaviour when
     serializing related objects.
+
+    For related managers, `limit` caps the number of related objects that
+    are serialized for each object, and `order_by` gives the field names
+    used to order them, as with `QuerySet.order_by`.
     """
 
+    def __init__(self, source=None, readonly=False, limit=None, order_by=None):
+        super(RelatedField, self).__init__(source, readonly)
+        self.limit = limit
+        self.order_by = order_by
+
     def field_to_native(self, obj, field_name):
         obj = getattr(obj, field_name)
-        if obj.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager'):
-            return [self.to_native(item) for item in obj.all()]
+        if is_related_manager(obj):
+            return [self.to_native(item) for item in self.get_related_items(obj, field_name)]
         return self.to_native(obj)
 
+    def field_to_native_batch(self, objs, field_name):
+        """
+        Load the related objects of reverse foreign keys, many to many and
+        generic relationships for all the objects with one query, so that
+        `field_to_native` then reads them from the prefetch cache.
+        """
+        try:
+            field, model, direct, m2m = objs[0]._meta.get_field_by_name(field_name)
+        except AttributeError:
+            return None
+        except FieldDoesNotExist:
+            field = get_generic_foreign_key(objs[0], field_name)
+            if field is not None:
+                self.prefetch_generic_foreign_key(objs, field)
+            return None
+        if not m2m and (direct or isinstance(field.field, OneToOneField)):
+            return None
+        objs = [obj for obj in objs if obj.pk is not None]
+        if not objs:
+            return None
+        if self.limit is None and not self.order_by:
+            prefetch_related_objects(objs, [field_name])
+            return None
+        manager = getattr(objs[0], field_name)
+        prefetcher = LimitedPrefetcher(manager, field, self.limit, self.order_by)
+        if self.limit is not None and (
+                connections[manager.db].vendor not in LIMITED_SUBQUERY_VENDORS or
+                prefetcher.get_ordering_fields() is None):
+            return None  # The limit can't be applied in a subquery, query each object instead
+        for obj in objs:
+            if not hasattr(obj, '_prefetched_objects_cache'):
+                obj._prefetched_objects_cache = {}
+        prefetch_one_level(objs, prefetcher, field_name)
+        # Kept apart from the relation's own prefetch cache, so that the
+        # model's manager still returns every related object.
+        for obj in objs:
+            items = obj._prefetched_objects_cache.pop(LimitedPrefetcher.cache_name)
+            obj.__dict__.setdefault(LIMITED_CACHE_ATTR, {})[field_name] = items
+        return None
+
+    def prefetch_generic_foreign_key(self, objs, field):
+        """
+        Load the targets of a generic foreign key with one query for each
+        content type, and set the content type of each object from the
+        `ContentType` cache.
+        """
+        ct_field = objs[0]._meta.get_field(field.ct_field)
+        cache_name = ct_field.get_cache_name()
+        manager = ct_field.rel.to._default_manager
+        for obj in objs:
+            ct_id = getattr(obj, ct_field.attname)
+            if ct_id is not None and not hasattr(obj, cache_name):
+                content_type = manager.db_manager(obj._state.db).get_for_id(ct_id)
+                setattr(obj, cache_name, content_type)
+        prefetch_related_objects(objs, [field.name])
+
+    def get_related_items(self, manager, field_name):
+        """
+        Returns the related objects of a related manager, applying the
+        `limit` and `order_by` options unless they have already been
+        prefetched.
+
+        Objects prefetched by `field_to_native_batch` are only used once.
+        """
+        limited = getattr(manager.instance, LIMITED_CACHE_ATTR, {})
+        if field_name in limited:
+            return limited.pop(field_name)
+        items = manager.all()
+        if items._result_cache is not None:
+            return items
+        if self.order_by:
+            items = items.order_by(*self.order_by)
+        if self.limit is not None:
+            items = items[:self.limit]
+        return items
+
     def attributes(self):
         try:
             return {
@@ -127,6 +247,140 @@ class RelatedField(Field):
             return {}
 
 
+def is_related_manager(obj):
+    """
+    True if obj is the manager of a reverse foreign key, many to many or
+    generic relationship.
+    """
+    return obj.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager',
+                                      'GenericRelatedObjectManager')
+
+
+def get_generic_foreign_key(obj, field_name):
+    """
+    Returns the generic foreign key of a model instance with the given
+    name, or None if there is no such field.
+    """
+    for field in obj._meta.virtual_fields:
+        if field.name == field_name and hasattr(field, 'ct_field'):
+            return field
+    return None
+
+
+# Database backends known to support ORDER BY and LIMIT in an IN subquery.
+LIMITED_SUBQUERY_VENDORS = ('sqlite', 'postgresql')
+
+# The instance attribute that holds the related objects prefetched by
+# `LimitedPrefetcher`, by field name.
+LIMITED_CACHE_ATTR = '_limited_objects_cache'
+
+
+class LimitedPrefetcher(object):
+    """
+    Prefetches the objects of a related manager for a list of instances,
+    ordered, and with at most `limit` objects for each instance.
+
+    The limit is applied by the database, with a correlated subquery that
+    selects the first `limit` related objects of each instance, so the
+    objects over the limit are never fetched.  The objects are prefetched
+    under `cache_name`, rather than the relation's own cache name.
+    """
+    cache_name = '_limited_objects'
+
+    def __init__(self, manager, field, limit=None, order_by=None):
+        self.manager = manager
+        self.field = field
+        self.limit = limit
+        self.order_by = order_by
+
+    def get_prefetch_query_set(self, instances):
+        ret = self.manager.get_prefetch_query_set(instances)
+        queryset = ret[0]
+        if self.order_by:
+            queryset = queryset.order_by(*self.order_by)
+        if self.limit is not None:
+            queryset = queryset.extra(where=[self.limit_clause(queryset.db)])
+        return (queryset,) + ret[1:4] + (self.cache_name,)
+
+    def get_ordering_fields(self):
+        """
+        Returns a list of `(field, descending)` pairs to order the related
+        objects by, ending with the primary key so that the order is always
+        the same, or None if the ordering uses anything other than fields
+        of the related model, such as related lookups or random ordering.
+        """
+        opts = self.manager.model._meta
+        ordering = []
+        for name in list(self.order_by or opts.ordering) + ['pk']:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                field = opts.pk
+            elif LOOKUP_SEP in name or name == '?':
+                return None
+            else:
+                try:
+                    field = opts.get_field(name)
+                except FieldDoesNotExist:
+                    return None
+            ordering.append((field, descending))
+        return ordering
+
+    def get_ordering(self, alias, qn):
+        """
+        Returns the ORDER BY columns for the related objects.
+        """
+        return ', '.join(['%s.%s%s' % (alias, qn(field.column), descending and ' DESC' or '')
+                          for field, descending in self.get_ordering_fields()])
+
+    def limit_clause(self, using):
+        qn = connections[using].ops.quote_name
+        opts = self.manager.model._meta
+        if hasattr(self.manager, 'object_id_field_name'):
+            # Generic relation, correlated on the content type and object id.
+            table = qn(opts.db_table)
+            column = qn(opts.pk.column)
+            subquery = ('SELECT U0.%(column)s FROM %(table)s U0 '
+                        'WHERE U0.%(object_id)s = %(table)s.%(object_id)s '
+                        'AND U0.%(content_type)s = %(table)s.%(content_type)s' % {
+                            'column': column,
+                            'table': table,
+                            'object_id': qn(opts.get_field(self.manager.object_id_field_name).column),
+                            'content_type': qn(opts.get_field(self.manager.content_type_field_name).column),
+                        })
+            alias = 'U0'
+        elif isinstance(self.field, ManyToManyField) or isinstance(self.field.field, ManyToManyField):
+            # Many to many, correlated on the join table.
+            through = self.manager.through._meta
+            source = through.get_field(self.manager.source_field_name)
+            target = through.get_field(self.manager.target_field_name)
+            table = qn(through.db_table)
+            column = qn(target.column)
+            subquery = ('SELECT U0.%(column)s FROM %(table)s U0 '
+                        'INNER JOIN %(model_table)s U1 ON (U0.%(column)s = U1.%(target)s) '
+                        'WHERE U0.%(source)s = %(table)s.%(source)s' % {
+                            'column': column,
+                            'table': table,
+                            'model_table': qn(opts.db_table),
+                            'target': qn(target.rel.get_related_field().column),
+                            'source': qn(source.column),
+                        })
+            alias = 'U1'
+        else:
+            # Reverse foreign key, correlated on the related model's table.
+            table = qn(opts.db_table)
+            column = qn(opts.pk.column)
+            subquery = ('SELECT U0.%(column)s FROM %(table)s U0 '
+                        'WHERE U0.%(fk)s = %(table)s.%(fk)s' % {
+                            'column': column,
+                            'table': table,
+                            'fk': qn(self.field.field.column),
+                        })
+            alias = 'U0'
+        return '%s.%s IN (%s ORDER BY %s LIMIT %d)' % (
+            table, column, subquery, self.get_ordering(alias, qn), self.limit)
+
+
 class PrimaryKeyRelatedField(RelatedField):
     """
     Serializes a model related field or related manager to a pk value.
@@ -160,13 +414,13 @@ class PrimaryKeyRelatedField(RelatedField):
         except AttributeError:
             field = obj._meta.get_field_by_name(field_name)[0]
             obj = getattr(obj, field_name)
-            if obj.__class__.__name__ == 'RelatedManager':
-                return [self.to_native(item.pk) for item in obj.all()]
+            if is_related_manager(obj):
+                return [self.to_native(item.pk) for item in self.get_related_items(obj, field_name)]
             elif isinstance(field, RelatedObject):
                 return self.to_native(obj.pk)
             raise
-        if obj.__class__.__name__ == 'ManyRelatedManager':
-            return [self.to_native(item.pk) for item in obj.all()]
+        if is_related_manager(obj):
+            return [self.to_native(item.pk) for item in self.get_related_items(obj, field_name)]
         return self.to_native(obj)
 
     def field_from_native(self, data, field_name, into):
@@ -188,6 +442,35 @@ class NaturalKeyRelatedField(RelatedField):
             return obj.natural_key()
         return obj
 
+    def field_to_native_batch(self, objs, field_name):
+        """
+        Load the related objects of a foreign key for all the objects with
+        one query, and return their natural keys.  The natural key of each
+        related object is only computed once for each chunk of objects.
+        """
+        try:
+            field, model, direct, m2m = objs[0]._meta.get_field_by_name(field_name)
+        except (AttributeError, FieldDoesNotExist):
+            return None
+        if not direct or m2m or not field.rel:
+            return super(NaturalKeyRelatedField, self).field_to_native_batch(objs, field_name)
+
+        to = field.rel.to
+        natural_keys = self.root._natural_keys
+        values = [getattr(obj, field.attname) for obj in objs]
+        missing = set(value for value in values
+                      if value is not None and (to, value) not in natural_keys)
+        if missing:
+            lookup = {'%s__in' % field.rel.field_name: missing}
+            queryset = to._base_manager.using(objs[0]._state.db).filter(**lookup)
+            for related in queryset:
+                value = getattr(related, field.rel.field_name)
+                natural_keys[(to, value)] = self.to_native(related)
+            if any((to, value) not in natural_keys for value in missing):
+                return None  # Let field_to_native raise DoesNotExist
+        return [value if value is None else natural_keys[(to, value)]
+                for value in values]
+
     def field_from_native(self, data, field_name, into):
         value = data.get(field_name)
         into[self.model_field.attname] = self.from_native(value)
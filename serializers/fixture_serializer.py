@@ -4,16 +4,7 @@ from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_unicode
 from serializers import Field, PrimaryKeyRelatedField, NaturalKeyRelatedField
 from serializers import Serializer
-from serializers.renderers import (
-    JSONRenderer,
-    YAMLRenderer,
-    DumpDataXMLRenderer
-)
-from serializers.parsers import (
-    JSONParser,
-    DumpDataXMLParser
-)
-from serializers.utils import DictWithMetadata
+from serializers.utils import Row
 
 
 class ModelNameField(Field):
@@ -21,20 +12,30 @@ class ModelNameField(Field):
     Serializes the model instance's model name.  Eg. 'auth.User'.
     """
     def field_to_native(self, obj, field_name):
-        return smart_unicode(obj._meta)
+        opts = obj._meta
+        if obj._deferred:
+            opts = opts.proxy_for_model._meta
+        return smart_unicode(opts)
+
+    def required_columns(self, obj, field_name):
+        return []
 
     def field_from_native(self, data, field_name, into):
         # We don't actually want to restore the model name metadata to a field.
         pass
 
 
+# The model fields included in fixtures for each model.
+_fixture_fields = {}
+
+
 class FixtureFields(Serializer):
     """
     A serializer which uses serializes all the local fields on a model.
     """
 
     # Use an unsorted dict to ensure byte-for-byte backwards compatability
-    _dict_class = DictWithMetadata
+    _dict_class = Row
 
     def default_fields(self, serialize, obj=None, data=None, nested=False):
         """
@@ -46,14 +47,8 @@ class FixtureFields(Serializer):
         else:
             cls = self.parent.model
 
-        # all local fields + all m2m fields without through relationship
-        opts = cls._meta.concrete_model._meta
-        fields = [field for field in opts.local_fields if field.serialize]
-        fields += [field for field in opts.many_to_many
-                   if field.serialize and field.rel.through._meta.auto_created]
-
         ret = SortedDict()
-        for model_field in fields:
+        for model_field in self.get_model_fields(cls):
             if model_field.rel and nested:
                 field = FixtureSerializer()
             elif model_field.rel:
@@ -64,6 +59,31 @@ class FixtureFields(Serializer):
             ret[model_field.name] = field
         return ret
 
+    def get_model_fields(self, cls):
+        """
+        Returns the model fields included in fixtures for the model.
+        The result is cached for each model class.
+        """
+        model = cls._meta.concrete_model
+        try:
+            return _fixture_fields[model]
+        except KeyError:
+            pass
+
+        # all local fields + all m2m fields without through relationship
+        opts = model._meta
+        fields = [field for field in opts.local_fields if field.serialize]
+        fields += [field for field in opts.many_to_many
+                   if field.serialize and field.rel.through._meta.auto_created]
+        _fixture_fields[model] = fields
+        return fields
+
+    def warm_up(self, models):
+        super(FixtureFields, self).warm_up(models)
+        for model in models:
+            self.get_model_fields(model)
+            model._meta.get_all_field_names()  # Populates the field name cache
+
     def _nk_or_pk_field(self, serialize, data, model_field):
         """
         Determine if natural key field or primary key field should be used.
@@ -83,7 +103,7 @@ class FixtureSerializer(Serializer):
     """
 
     # NB: Unsorted dict to ensure byte-for-byte backwards compatability
-    _dict_class = DictWithMetadata
+    _dict_class = Row
 
     pk = Field()
     model = ModelNameField()
@@ -91,13 +111,15 @@ class FixtureSerializer(Serializer):
 
     class Meta:
         renderer_classes = {
-            'xml': DumpDataXMLRenderer,
-            'json': JSONRenderer,
-            'yaml': YAMLRenderer,
+            'xml': 'serializers.renderers.DumpDataXMLRenderer',
+            'json': 'serializers.renderers.JSONRenderer',
+            'jsonl': 'serializers.renderers.JSONLinesRenderer',
+            'yaml': 'serializers.renderers.YAMLRenderer',
         }
         parser_classes = {
-            'xml': DumpDataXMLParser,
-            'json': JSONParser
+            'xml': 'serializers.parsers.DumpDataXMLParser',
+            'json': 'serializers.parsers.JSONParser',
+            'jsonl': 'serializers.parsers.JSONLinesParser',
         }
 
     def serialize(self, *args, **kwargs):
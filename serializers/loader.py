@@ -0,0 +1,428 @@
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import AutoField
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
+from django.utils.translation import ugettext as _
+
+
+class BulkLoader(object):
+    """
+    Loads deserialized objects into the database with batched INSERT
+    statements, rather than saving each object in turn.
+
+    Objects may be `DeserializedObject` instances, as returned by
+    `FixtureSerializer.deserialize`, or plain model instances.
+
+    As with `QuerySet.bulk_create`, no signals are sent and model `save`
+    methods are not called for the objects that are inserted in batches.
+    Field values are inserted as they are, as with a raw save during
+    `loaddata`.  The rows must not already exist.
+
+    Tables are inserted in levels, so that each table is inserted after
+    the tables its foreign keys refer to.  Nullable foreign keys to rows
+    that are inserted in the same level or a later one, such as
+    self-referential or cyclic relationships, are inserted as NULL and
+    then set with batched UPDATE statements once all the rows exist.
+
+    With `threads`, the tables in each level are inserted concurrently,
+    each on its own connection, where the database allows it.  Every table
+    is then inserted and committed on a worker connection, and each level
+    is committed before the next one starts, so the load is no longer
+    atomic.
+
+    With `validate`, every foreign key and many to many value is checked
+    before anything is written, and a `ValidationError` listing each value
+    that refers to an object that does not exist is raised.
+
+    Objects that have no primary key are saved one by one instead if they
+    are of an inherited model, have many to many data, or have a nullable
+    foreign key that would otherwise be set afterwards, as their primary
+    keys are needed first.  These are saved with `Model.save_base`, which
+    sends the `pre_save` and `post_save` signals.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=None, threads=1,
+                 validate=False):
+        self.using = using
+        self.batch_size = batch_size
+        self.threads = threads
+        self.validate = validate
+
+    def load(self, objects):
+        """
+        Insert the objects, followed by their many to many relationships,
+        and return the number of objects loaded.
+        """
+        objs = []
+        unsaved = []
+        m2m_data = []
+        for obj in objects:
+            has_m2m_data = False
+            if hasattr(obj, 'object'):
+                if obj.m2m_data:
+                    m2m_data.append((obj.object, obj.m2m_data))
+                    has_m2m_data = True
+                obj = obj.object
+            if obj.pk is None and (has_m2m_data or obj._meta.parents):
+                unsaved.append(obj)
+            else:
+                objs.append(obj)
+
+        tables = self.get_tables(objs)
+        if self.validate:
+            self.check_references(objs + unsaved, m2m_data, tables)
+        levels = self.get_levels(tables)
+        deferred, postponed = self.defer_foreign_keys(tables, levels)
+        concurrent = self.is_concurrent()
+        try:
+            if concurrent:
+                # Committed level by level, so that the rows of each level
+                # are visible to the connections inserting the next one.
+                for level in levels:
+                    self.insert_level(level, tables, concurrent)
+            with transaction.commit_on_success(using=self.using):
+                if not concurrent:
+                    for level in levels:
+                        self.insert_level(level, tables)
+                for model, field, values in deferred:
+                    self.update(model, field, values)
+                for obj in postponed + unsaved:
+                    models.Model.save_base(obj, using=self.using)
+                self.insert_m2m(m2m_data)
+                self.reset_sequences(tables.keys())
+        finally:
+            for model, field, values in deferred:
+                for obj, value in values:
+                    setattr(obj, field.attname, value)
+        return len(objs) + len(unsaved)
+
+    def get_tables(self, objs):
+        """
+        Returns a dictionary of the objects to insert into each table,
+        keyed by the model that owns the table.
+
+        Objects of models that use multi-table inheritance are included
+        in the tables of each of their parents, ahead of their own table,
+        unless the parent objects with the same primary keys are also
+        being loaded, as in fixtures created by `dumpdata`.
+        """
+        tables = SortedDict()
+        explicit = {}
+        for obj in objs:
+            model = obj._meta.concrete_model
+            explicit.setdefault(model, set()).add(obj.pk)
+
+        for obj in objs:
+            model = obj._meta.concrete_model
+            self.set_parent_pks(obj, model)
+            for table in self.get_ancestors(model) + [model]:
+                if table is not model and obj.pk in explicit.get(table, ()):
+                    continue
+                tables.setdefault(table, []).append(obj)
+        return tables
+
+    def get_ancestors(self, model):
+        """
+        Returns the concrete parents of a model, most distant first.
+        """
+        ret = []
+        for parent in model._meta.parents:
+            for ancestor in self.get_ancestors(parent) + [parent]:
+                if ancestor not in ret:
+                    ret.append(ancestor)
+        return ret
+
+    def set_parent_pks(self, obj, model):
+        """
+        Copy the primary key of an object into the primary key field of
+        each of its parents, as `Model.save` does.
+        """
+        for parent, field in model._meta.parents.items():
+            if field is None:
+                continue
+            value = getattr(obj, field.attname)
+            if value is not None:
+                setattr(obj, parent._meta.pk.attname, value)
+                self.set_parent_pks(obj, parent)
+
+    def check_references(self, objs, m2m_data, tables):
+        """
+        Check that the foreign key and many to many values of the objects
+        refer to objects that are being loaded or that already exist, with
+        one query for each related model.
+
+        Raises a `ValidationError` that lists every missing reference.
+        """
+        references = SortedDict()
+
+        def add(model, field, value, obj, field_name):
+            values = references.setdefault((model._meta.concrete_model, field), SortedDict())
+            values.setdefault(value, []).append((obj, field_name))
+
+        for obj in objs:
+            for field in obj._meta.fields:
+                if field.rel and not field.rel.parent_link:
+                    value = getattr(obj, field.attname)
+                    if value is not None:
+                        add(field.rel.to, field.rel.get_related_field(), value, obj, field.name)
+        for obj, data in m2m_data:
+            for field_name, values in data.items():
+                to = obj._meta.get_field(field_name).rel.to
+                for value in values:
+                    add(to, to._meta.pk, getattr(value, 'pk', value), obj, field_name)
+
+        ops = connections[self.using].ops
+        errors = []
+        for (model, field), values in references.items():
+            loaded = set(getattr(obj, field.attname) for obj in tables.get(model, ()))
+            missing = [value for value in values if value not in loaded]
+            batch_size = max(ops.bulk_batch_size([field], missing), 1)
+            queryset = model._base_manager.using(self.using)
+            existing = set()
+            for start in range(0, len(missing), batch_size):
+                lookup = {'%s__in' % field.name: missing[start:start + batch_size]}
+                existing.update(queryset.filter(**lookup).values_list(field.attname, flat=True))
+            for value in missing:
+                if value in existing:
+                    continue
+                for obj, field_name in values[value]:
+                    errors.append(_(u"%(object)s: %(model)s with %(field)s %(value)r "
+                                    u"does not exist.") % {
+                        'object': u'%s(pk=%r)' % (smart_unicode(obj._meta), obj.pk),
+                        'model': smart_unicode(model._meta),
+                        'field': field.name,
+                        'value': value,
+                    })
+        if errors:
+            raise ValidationError(errors)
+
+    def get_levels(self, tables):
+        """
+        Sort the tables into a list of levels, where the tables in each
+        level only have foreign keys to the tables in earlier levels.
+
+        Where the foreign keys form a cycle, a table that only depends on
+        the others through nullable foreign keys is put first.
+        """
+        required = {}
+        nullable = {}
+        for model in tables:
+            required[model] = set()
+            nullable[model] = set()
+            for field in model._meta.local_fields:
+                if not field.rel:
+                    continue
+                target = field.rel.to._meta.concrete_model
+                if target is model or target not in tables:
+                    continue
+                if field.null and not field.rel.parent_link:
+                    nullable[model].add(target)
+                else:
+                    required[model].add(target)
+
+        levels = []
+        remaining = list(tables)
+        while remaining:
+            pending = set(remaining)
+            level = [model for model in remaining
+                     if not (required[model] | nullable[model]) & pending]
+            if not level:
+                level = [model for model in remaining
+                         if not required[model] & pending][:1] or remaining
+            levels.append(level)
+            remaining = [model for model in remaining if model not in level]
+        return levels
+
+    def defer_foreign_keys(self, tables, levels):
+        """
+        Set nullable foreign keys to NULL where they refer to objects that
+        are inserted in the same level or a later one, and return a list
+        of (model, field, [(obj, value), ...]) to set afterwards.
+
+        Objects without a primary key can't be updated afterwards, so
+        those that have such foreign keys are removed from their tables
+        instead, and returned in a second list to be saved one by one once
+        every table has been inserted.
+        """
+        order = {}
+        for index, level in enumerate(levels):
+            for model in level:
+                order[model] = index
+        loaded = {}
+        deferred = []
+        unsaved = []
+
+        def is_deferred(obj, field, targets):
+            value = getattr(obj, field.attname)
+            return value is not None and value in targets
+
+        for model, objs in tables.items():
+            fields = []
+            for field in model._meta.local_fields:
+                if not field.rel or not field.null or field.rel.parent_link:
+                    continue
+                target = field.rel.to._meta.concrete_model
+                if order.get(target, -1) < order[model]:
+                    continue  # Already inserted, or not being loaded
+                target_field = field.rel.get_related_field()
+                key = (target, target_field.attname)
+                if key not in loaded:
+                    loaded[key] = set(getattr(obj, target_field.attname)
+                                      for obj in tables[target])
+                fields.append((field, loaded[key]))
+
+            if fields:
+                postponed = [obj for obj in objs if obj.pk is None and
+                             any(is_deferred(obj, field, targets) for field, targets in fields)]
+                if postponed:
+                    postponed_ids = set(map(id, postponed))
+                    objs[:] = [obj for obj in objs if id(obj) not in postponed_ids]
+                    unsaved.extend(postponed)
+            for field, targets in fields:
+                values = []
+                for obj in objs:
+                    if is_deferred(obj, field, targets):
+                        values.append((obj, getattr(obj, field.attname)))
+                        setattr(obj, field.attname, None)
+                if values:
+                    deferred.append((model, field, values))
+        return deferred, unsaved
+
+    def is_concurrent(self):
+        """
+        True if the tables in each level should be inserted concurrently.
+        SQLite only allows one writer at a time, and a transaction that is
+        already being managed by the caller must include every insert.
+        """
+        return (self.threads > 1 and
+                connections[self.using].vendor != 'sqlite' and
+                not transaction.is_managed(using=self.using))
+
+    def insert_level(self, level, tables, concurrent=False):
+        """
+        Insert the tables of one level, concurrently if required.
+
+        When inserting concurrently, even a level with a single table is
+        inserted and committed on a worker connection, as the main
+        connection's transaction would not be visible to the others.
+        """
+        if not concurrent:
+            for model in level:
+                self.insert(model, tables[model])
+            return
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.threads, len(level)))
+        try:
+            pool.map(self.insert_table, [(model, tables[model]) for model in level])
+        finally:
+            pool.close()
+            pool.join()
+
+    def insert_table(self, args):
+        """
+        Insert and commit a table, on the current thread's connection.
+        """
+        model, objs = args
+        try:
+            with transaction.commit_on_success(using=self.using):
+                self.insert(model, objs)
+        finally:
+            connections[self.using].close()
+
+    def insert(self, model, objs, fields=None):
+        """
+        Insert the objects into a model's table, in batches.
+
+        Only the model's local fields are inserted, so objects of a child
+        model may be inserted into each of its parent's tables in turn.
+        """
+        if fields is None:
+            fields = model._meta.local_fields
+            with_pk = [obj for obj in objs if obj.pk is not None]
+            without_pk = [obj for obj in objs if obj.pk is None]
+            if without_pk and model._meta.has_auto_field:
+                self.insert(model, with_pk, fields)
+                fields = [field for field in fields if not isinstance(field, AutoField)]
+                objs = without_pk
+        if not objs:
+            return
+
+        ops = connections[self.using].ops
+        batch_size = self.batch_size or max(ops.bulk_batch_size(fields, objs), 1)
+        for start in range(0, len(objs), batch_size):
+            model._base_manager._insert(objs[start:start + batch_size], fields=fields,
+                                        using=self.using, raw=True)
+
+    def update(self, model, field, values):
+        """
+        Set a field of the inserted objects with batched
+        `UPDATE ... SET column = CASE pk WHEN ... END` statements.
+        """
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        pk = model._meta.pk
+        batch_size = (self.batch_size or
+                      max(connection.ops.bulk_batch_size([pk, field, pk], values), 1))
+        cursor = connection.cursor()
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            pks = [pk.get_db_prep_value(getattr(obj, pk.attname), connection)
+                   for obj, value in batch]
+            params = []
+            for pk_value, (obj, value) in zip(pks, batch):
+                params.append(pk_value)
+                params.append(field.get_db_prep_save(value, connection))
+            sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(model._meta.db_table), qn(field.column), qn(pk.column),
+                ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                qn(pk.column), ', '.join(['%s'] * len(batch)))
+            cursor.execute(sql, params + pks)
+
+    def insert_m2m(self, m2m_data):
+        """
+        Insert the rows of the automatically created intermediary tables
+        for the many to many relationships of the objects.
+
+        Symmetrical relationships are also inserted in reverse, as
+        assigning to the relationship would do.
+        """
+        through_rows = SortedDict()
+        for obj, data in m2m_data:
+            for field_name, values in data.items():
+                field = obj._meta.get_field(field_name)
+                through = field.rel.through
+                if not through._meta.auto_created:
+                    continue
+                source = through._meta.get_field(field.m2m_field_name()).attname
+                target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                pairs = through_rows.setdefault((through, source, target), SortedDict())
+                for value in values:
+                    value = getattr(value, 'pk', value)
+                    pairs[(obj.pk, value)] = True
+                    if field.rel.symmetrical and field.rel.to == obj._meta.concrete_model:
+                        pairs[(value, obj.pk)] = True
+
+        for (through, source, target), pairs in through_rows.items():
+            rows = [through(**{source: source_pk, target: target_pk})
+                    for source_pk, target_pk in pairs]
+            fields = [field for field in through._meta.local_fields
+                      if not isinstance(field, AutoField)]
+            self.insert(through, rows, fields)
+
+    def reset_sequences(self, tables):
+        """
+        Reset the database sequences of every table that was inserted into,
+        as `loaddata` does, as the objects are inserted with their primary
+        keys.  This includes the parent tables of inherited models.
+        """
+        if not tables:
+            return
+        connection = connections[self.using]
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(), list(tables))
+        if sequence_sql:
+            cursor = connection.cursor()
+            for line in sequence_sql:
+                cursor.execute(line)
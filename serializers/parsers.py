@@ -1,6 +1,9 @@
+import itertools
 import json
-from xml.dom import pulldom
 from django.core.serializers.base import DeserializationError
+from django.utils.dateparse import parse_date, parse_datetime
+from serializers.fields import DateField, DateTimeField, Field, FloatField, IntegerField
+from serializers.utils import MessagePackDecoder, optional_import
 
 
 class JSONParser(object):
@@ -12,8 +15,193 @@ class JSONParser(object):
             raise DeserializationError(e)
 
 
+class JSONLinesParser(object):
+    """
+    Parses JSON Lines, yielding one object per line.
+
+    Lines are read in chunks of `chunk_size`, and blank lines are ignored.
+    Passing `offset` skips that many lines first, so that an interrupted
+    load can be restarted from where it left off.
+    """
+    def parse(self, stream, offset=0, chunk_size=1000, **opts):
+        lines = itertools.islice(stream, offset, None)
+        lineno = offset
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            for line in chunk:
+                lineno += 1
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError as e:
+                    raise DeserializationError('Line %d: %s' % (lineno, e))
+                yield obj
+
+
+class ColumnarJSONParser(object):
+    """
+    Parses columnar JSON, as written by `ColumnarJSONRenderer`, back into a
+    list of objects, or a single object if it is marked `"many": false`.
+    Both the column and row orientations are supported.
+    """
+    def parse(self, stream, **opts):
+        try:
+            data = json.load(stream)
+            columns, values = data['columns'], data['data']
+            if isinstance(values, dict):
+                values = zip(*[values[key] for key in columns])
+            many = data.get('many', True)
+            if not many and len(values) != 1:
+                raise ValueError('Expected a single row, found %d' % len(values))
+        except Exception as e:
+            # Map to deserializer error
+            raise DeserializationError(e)
+        objs = [dict(zip(columns, row)) for row in values]
+        return objs if many else objs[0]
+
+
+class MessagePackParser(object):
+    """
+    Parses a stream of MessagePack objects, yielding each object in turn.
+    Uses the `msgpack` package if it is installed.
+
+    A single rendered object can't be told apart from a list of one, so
+    pass `many=False` to read it back as the object itself.
+    """
+    lazy_imports = ('msgpack',)
+
+    def parse(self, stream, many=True, **opts):
+        msgpack = optional_import('msgpack')
+        if msgpack:
+            decoder = msgpack.Unpacker(stream, raw=False)
+        else:
+            decoder = MessagePackDecoder(stream)
+        objs = self._decode(decoder)
+        if many:
+            return objs
+        objs = list(objs)
+        if len(objs) != 1:
+            raise DeserializationError('Expected a single MessagePack object, found %d' % len(objs))
+        return objs[0]
+
+    def _decode(self, decoder):
+        try:
+            for obj in decoder:
+                yield obj
+        except Exception as e:
+            # Map to deserializer error
+            raise DeserializationError(e)
+
+
+def _parse_dates(parse):
+    """
+    Returns a column converter that parses every value with `parse`,
+    failing if any value is not in the expected format.
+    """
+    def convert(values):
+        parsed = map(parse, values)
+        if None in parsed:
+            raise ValueError()
+        return parsed
+    return convert
+
+
+class CSVParser(object):
+    """
+    Parses CSV data into a stream of dicts, one per row.
+
+    The header is read once, and rows are then processed in chunks of
+    `chunk_size`, so memory use is bounded by the chunk size rather than by
+    the size of the input.  If `fields` is given, each column is coerced
+    as a whole using the serializer field with the same name.
+    """
+    uses_fields = True  # Columns are coerced using the serializer's fields
+    lazy_imports = ('csv',)
+    column_converters = {
+        IntegerField: lambda values: map(int, values),
+        FloatField: lambda values: map(float, values),
+        DateTimeField: _parse_dates(parse_datetime),
+        DateField: _parse_dates(parse_date),
+    }
+    # Converters for the plain fields of a `ModelSerializer`, keyed on the
+    # internal type of their model field.
+    model_column_converters = {
+        'AutoField': column_converters[IntegerField],
+        'IntegerField': column_converters[IntegerField],
+        'BigIntegerField': column_converters[IntegerField],
+        'SmallIntegerField': column_converters[IntegerField],
+        'PositiveIntegerField': column_converters[IntegerField],
+        'PositiveSmallIntegerField': column_converters[IntegerField],
+        'FloatField': column_converters[FloatField],
+        'DateTimeField': column_converters[DateTimeField],
+        'DateField': column_converters[DateField],
+    }
+
+    def parse(self, stream, fields=None, chunk_size=1000, encoding='utf-8', **opts):
+        import csv
+        reader = csv.reader(stream)
+        try:
+            header = [key.decode(encoding) for key in reader.next()]
+        except StopIteration:
+            return
+        except csv.Error as e:
+            raise DeserializationError(e)
+
+        fields = fields or {}
+        columns = [fields.get(key) for key in header]
+
+        while True:
+            try:
+                rows = list(itertools.islice(reader, chunk_size))
+            except csv.Error as e:
+                raise DeserializationError(e)
+            if not rows:
+                return
+            if any(len(row) != len(header) for row in rows):
+                raise DeserializationError('CSV row does not match the header')
+            values = [
+                self.coerce_column(field, [value.decode(encoding) for value in column])
+                for field, column in zip(columns, zip(*rows))
+            ]
+            for row in zip(*values):
+                yield dict(zip(header, row))
+
+    def coerce_column(self, field, values):
+        """
+        Coerce a column of values using the field's type.
+
+        Known field types convert the whole column in a single pass, falling
+        back to the field's own `from_native` so that invalid values are
+        reported in the usual way.
+        """
+        if field is None:
+            return values
+        converter = self.get_column_converter(field)
+        if converter is not None:
+            try:
+                return converter(values)
+            except (TypeError, ValueError):
+                pass
+        return [field.from_native(value) for value in values]
+
+    def get_column_converter(self, field):
+        """
+        Returns the function that converts a whole column for the given
+        field, or None if its values must be converted one at a time.
+        """
+        if field.__class__ is Field and hasattr(field, 'model_field'):
+            return self.model_column_converters.get(field.model_field.get_internal_type())
+        return self.column_converters.get(field.__class__)
+
+
 class DumpDataXMLParser(object):
+    lazy_imports = ('xml.dom.pulldom',)
+
     def parse(self, stream):
+        from xml.dom import pulldom
         event_stream = pulldom.parse(stream)
         for event, node in event_stream:
             if event == "START_ELEMENT" and node.nodeName == "object":
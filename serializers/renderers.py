@@ -1,19 +1,17 @@
 import datetime
+import itertools
 from django.utils import simplejson as json
+from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_unicode
-from django.utils.html import urlize
-from django.utils.xmlutils import SimplerXMLGenerator
-from serializers.utils import SafeDumper, DictWriter, DjangoJSONEncoder
-try:
-    import yaml
-except ImportError:
-    yaml = None
+from serializers.utils import DictWriter, DjangoJSONEncoder, get_safe_dumper
+from serializers.utils import MessagePackEncoder, is_installed, optional_import
 
 
 class BaseRenderer(object):
     """
     Defines the base interface that renderers should implement.
     """
+    lazy_imports = ()  # Modules imported on first use, see `warm_up()`
 
     def render(obj, stream, **opts):
         return str(obj)
@@ -30,22 +28,141 @@ class JSONRenderer(BaseRenderer):
                          indent=indent, sort_keys=sort_keys)
 
 
+class JSONLinesRenderer(BaseRenderer):
+    """
+    Render a native python object into JSON Lines, with one object per line.
+
+    Each line is flushed as it is written, unless `flush=False` is passed.
+    """
+    def render(self, obj, stream, **opts):
+        flush = opts.pop('flush', True) and getattr(stream, 'flush', None)
+        if isinstance(obj, dict) or not hasattr(obj, '__iter__'):
+            obj = [obj]
+        for item in obj:
+            stream.write(json.dumps(item, cls=DjangoJSONEncoder))
+            stream.write('\n')
+            if flush:
+                flush()
+
+
+class ColumnarJSONRenderer(BaseRenderer):
+    """
+    Render a list of objects that share the same fields into columnar JSON.
+
+    The field names are written once, as a header, instead of being
+    repeated for every object.  By default the values are grouped by column:
+
+        {"columns": ["id", "name"], "data": {"id": [1, 2], "name": ["a", "b"]}}
+
+    Passing `orient='rows'` instead writes one array of values per object.
+    This form is streamed, rather than built in memory:
+
+        {"columns": ["id", "name"], "data": [[1, "a"], [2, "b"]]}
+
+    A single object is written as a list of one, marked with
+    `"many": false` so that it is parsed back as the object itself.
+    """
+    def render(self, obj, stream, **opts):
+        orient = opts.pop('orient', 'columns')
+        indent = opts.pop('indent', None)
+        many = not isinstance(obj, dict) and hasattr(obj, '__iter__')
+        if not many:
+            obj = [obj]
+
+        rows = iter(obj)
+        try:
+            first = next(rows)
+        except StopIteration:
+            columns, rows = [], iter(())
+        else:
+            columns = first.keys()
+            rows = itertools.chain([first], rows)
+        rows = (self._row_values(item, columns) for item in rows)
+
+        if orient == 'rows':
+            stream.write('{"columns": %s, ' % self._dumps(columns))
+            if not many:
+                stream.write('"many": false, ')
+            stream.write('"data": [')
+            for index, values in enumerate(rows):
+                if index:
+                    stream.write(', ')
+                stream.write(self._dumps(values))
+            stream.write(']}')
+        else:
+            data = SortedDict([(key, []) for key in columns])
+            appends = [data[key].append for key in columns]
+            for values in rows:
+                for append, value in zip(appends, values):
+                    append(value)
+            ret = SortedDict([('columns', columns)])
+            if not many:
+                ret['many'] = False
+            ret['data'] = data
+            json.dump(ret, stream, cls=DjangoJSONEncoder, indent=indent)
+
+    def _dumps(self, obj):
+        return json.dumps(obj, cls=DjangoJSONEncoder)
+
+    def _row_values(self, item, columns):
+        if len(item) != len(columns):
+            raise ValueError('Columnar output requires every object to have the same fields')
+        try:
+            return [item[key] for key in columns]
+        except KeyError:
+            raise ValueError('Columnar output requires every object to have the same fields')
+
+
 class YAMLRenderer(BaseRenderer):
     """
     Render a native python object into YAML.
     """
+    lazy_imports = ('yaml',)
+
     def render(self, obj, stream, **opts):
         indent = opts.pop('indent', None)
         default_flow_style = opts.pop('default_flow_style', None)
-        return yaml.dump(obj, stream, Dumper=SafeDumper,
+        import yaml
+        return yaml.dump(obj, stream, Dumper=get_safe_dumper(),
                          indent=indent, default_flow_style=default_flow_style)
 
 
+class MessagePackRenderer(BaseRenderer):
+    """
+    Render a native python object into MessagePack.
+
+    Lists are rendered as a stream of objects, one after the other, rather
+    than as a single array.  This means output can be written and read back
+    one object at a time, without knowing the length of the list up front.
+    A single object is written on its own, and is read back with
+    `many=False`.  Uses the `msgpack` package if it is installed.
+    """
+    lazy_imports = ('msgpack',)
+
+    def render(self, obj, stream, **opts):
+        encoder = MessagePackEncoder()
+        msgpack = optional_import('msgpack')
+        if msgpack:
+            packer = msgpack.Packer(default=encoder.default, use_bin_type=False)
+            encode = packer.pack
+        else:
+            encode = encoder.encode
+
+        if isinstance(obj, dict) or not hasattr(obj, '__iter__'):
+            obj = [obj]
+        for item in obj:
+            stream.write(encode(item))
+
+
 class HTMLRenderer(BaseRenderer):
     """
     A basic html renderer, that renders data into tabular format.
     """
+    lazy_imports = ('django.utils.html',)
+
     def render(self, obj, stream, **opts):
+        from django.utils.html import urlize
+        self.urlize = urlize
         self._to_html(stream, obj)
 
     def _to_html(self, stream, data):
@@ -66,14 +183,17 @@ class HTMLRenderer(BaseRenderer):
             stream.write('</ul>\n')
 
         else:
-            stream.write(urlize(smart_unicode(data)))
+            stream.write(self.urlize(smart_unicode(data)))
 
 
 class XMLRenderer(BaseRenderer):
     """
     Render a native python object into a generic XML format.
     """
+    lazy_imports = ('django.utils.xmlutils',)
+
     def render(self, obj, stream, **opts):
+        from django.utils.xmlutils import SimplerXMLGenerator
         xml = SimplerXMLGenerator(stream, 'utf-8')
         xml.startDocument()
         self._to_xml(xml, obj)
@@ -104,7 +224,10 @@ class DumpDataXMLRenderer(BaseRenderer):
     """
     Render a native python object into XML dumpdata format.
     """
+    lazy_imports = ('django.utils.xmlutils',)
+
     def render(self, obj, stream, **opts):
+        from django.utils.xmlutils import SimplerXMLGenerator
         xml = SimplerXMLGenerator(stream, 'utf-8')
         xml.startDocument()
         xml.startElement('django-objects', {'version': '1.0'})
@@ -127,19 +250,16 @@ class DumpDataXMLRenderer(BaseRenderer):
 
         xml.startElement('object', attrs)
 
-        # For each item in fields get it's key, value and serializer field
-        key_val_field = [
-            (key, val, fields_data.fields[key])
-            for key, val in fields_data.items()
-        ]
-
         # Due to implmentation details, the existing xml dumpdata format
         # renders ordered fields, whilst json and yaml render unordered
         # fields (ordering determined by python's `dict` implementation)
-        # To maintain byte-for-byte backwards compatability,
-        # we'll deal with that now.
-        key_val_field = sorted(key_val_field,
-                               key=lambda x: x[2].creation_counter)
+        # To maintain byte-for-byte backwards compatability, render the
+        # fields in creation order, as given by the shared row schema.
+        schema = fields_data.schema
+        key_val_field = [
+            (key, fields_data[key], schema.fields[key])
+            for key in schema.creation_order if key in fields_data
+        ]
 
         for key, value, serializer_field in key_val_field:
             attrs = {'name': key}
@@ -178,7 +298,92 @@ class DumpDataXMLRenderer(BaseRenderer):
         xml.addQuickElement('None')
 
 
+class NumPyRenderer(BaseRenderer):
+    """
+    Render a queryset into a NumPy structured array, in `.npy` format.
+
+    The array's dtype is determined from the model fields.  Rows are read
+    with `values_list` in chunks of `chunk_size`, and each chunk is copied
+    into a preallocated array in a single operation.  Only numeric, boolean,
+    date and datetime fields, and relationships to them, are supported.
+    """
+    lazy_imports = ('numpy',)
+    renders_querysets = True  # ModelSerializer passes querysets unconverted
+    dtypes = {
+        'AutoField': 'i8',
+        'BigIntegerField': 'i8',
+        'IntegerField': 'i8',
+        'PositiveIntegerField': 'i8',
+        'PositiveSmallIntegerField': 'i8',
+        'SmallIntegerField': 'i8',
+        'FloatField': 'f8',
+        'DecimalField': 'f8',
+        'BooleanField': '?',
+        'DateField': 'M8[D]',
+        'DateTimeField': 'M8[us]',
+    }
+
+    def render(self, obj, stream, **opts):
+        import numpy
+        numpy.save(stream, self.to_array(obj, **opts))
+
+    def to_array(self, queryset, fields=None, chunk_size=10000):
+        """
+        Returns a structured array containing the queryset's rows.
+
+        `fields` may be a dict of serializer fields, as used by
+        `ModelSerializer`, and otherwise defaults to all the model's
+        concrete fields.
+        """
+        if not hasattr(queryset, 'values_list'):
+            raise TypeError('NumPyRenderer can only render querysets')
+        import numpy
+        if fields is None:
+            model_fields = [(field.name, field) for field in queryset.model._meta.fields]
+        else:
+            model_fields = [(key, getattr(field, 'model_field', None))
+                            for key, field in fields.items()]
+
+        dtype = numpy.dtype([(str(key), self.get_dtype(key, model_field))
+                             for key, model_field in model_fields])
+        rows = queryset.values_list(*[model_field.attname
+                                      for key, model_field in model_fields])
+        rows = rows.iterator()
+
+        array = numpy.empty(queryset.count(), dtype=dtype)
+        start = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            end = start + len(chunk)
+            if end > len(array):
+                array = numpy.resize(array, end)
+            array[start:end] = numpy.array(chunk, dtype=dtype)
+            start = end
+        return array[:start]
+
+    def get_dtype(self, key, model_field):
+        """
+        Returns the dtype to use for a column, given its model field.
+        """
+        if getattr(model_field, 'rel', None):
+            if model_field not in model_field.model._meta.fields:
+                model_field = None  # Many to many or reverse relationship
+            else:
+                model_field = model_field.rel.get_related_field()
+        try:
+            dtype = self.dtypes[model_field.get_internal_type()]
+        except (AttributeError, KeyError):
+            raise ValueError("Field '%s' cannot be rendered as a NumPy array" % key)
+        if dtype in ('i8', '?') and model_field.null:
+            dtype = 'f8'  # Integer and boolean dtypes cannot represent nulls
+        return dtype
+
+
 class CSVRenderer(BaseRenderer):
+    lazy_imports = ('csv',)
+
     def render(self, obj, stream, **opts):
         if isinstance(obj, dict) or not hasattr(obj, '__iter__'):
             obj = [obj]
@@ -189,5 +394,8 @@ class CSVRenderer(BaseRenderer):
                 writer.writeheader()
             writer.writerow(item)
 
-if not yaml:
+if not is_installed('yaml'):
     YAMLRenderer = None
+
+if not is_installed('numpy'):
+    NumPyRenderer = None
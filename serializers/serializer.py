@@ -1,29 +1,47 @@
 from decimal import Decimal
 from django.core.serializers.base import DeserializedObject
+from django.db.models.query import QuerySet, ValuesQuerySet
 from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
+import collections
 import copy
 import datetime
+import itertools
 import types
-from serializers.renderers import (
-    JSONRenderer,
-    YAMLRenderer,
-    XMLRenderer,
-    HTMLRenderer,
-    CSVRenderer,
-)
-from serializers.parsers import (
-    JSONParser,
-)
 from serializers.fields import *
-from serializers.utils import SortedDictWithMetadata, is_simple_callable
+from serializers.utils import ClassRegistry, RowSchema, SortedRow, is_simple_callable
+from serializers.utils import DeferredValue, optional_import, resolve_deferred
+from serializers.utils import CompressedWriter, DecompressedReader, is_compressed
+from serializers.utils import ParallelGzipWriter, input_stream
 from StringIO import StringIO
-from io import BytesIO
 
 
 class RecursionOccured(BaseException):
     pass
 
 
+# Renderers and parsers are given as dotted paths, and only imported the
+# first time each format is used.
+DEFAULT_RENDERER_CLASSES = {
+    'xml': 'serializers.renderers.XMLRenderer',
+    'json': 'serializers.renderers.JSONRenderer',
+    'yaml': 'serializers.renderers.YAMLRenderer',
+    'csv': 'serializers.renderers.CSVRenderer',
+    'html': 'serializers.renderers.HTMLRenderer',
+    'msgpack': 'serializers.renderers.MessagePackRenderer',
+    'columnar': 'serializers.renderers.ColumnarJSONRenderer',
+    'jsonl': 'serializers.renderers.JSONLinesRenderer',
+}
+
+DEFAULT_PARSER_CLASSES = {
+    'json': 'serializers.parsers.JSONParser',
+    'csv': 'serializers.parsers.CSVParser',
+    'msgpack': 'serializers.parsers.MessagePackParser',
+    'columnar': 'serializers.parsers.ColumnarJSONParser',
+    'jsonl': 'serializers.parsers.JSONLinesParser',
+}
+
+
 def _is_protected_type(obj):
     """
     True if the object is a native datatype that does not need to
@@ -38,6 +56,22 @@ def _is_protected_type(obj):
     )
 
 
+def _copy_native(data):
+    """
+    Copy converted data, including any nested dicts and lists, so that a
+    cached result can be returned more than once without being aliased.
+    """
+    if isinstance(data, dict):
+        ret = copy.copy(data)
+        for key, value in ret.items():
+            if isinstance(value, (dict, list)):
+                ret[key] = _copy_native(value)
+        return ret
+    elif isinstance(data, list):
+        return [_copy_native(item) for item in data]
+    return data
+
+
 def _get_declared_fields(bases, attrs):
     """
     Create a list of serializer field instances from the passed in 'attrs',
@@ -60,6 +94,98 @@ def _get_declared_fields(bases, attrs):
     return SortedDict(fields)
 
 
+def _get_subclasses(cls):
+    """
+    Returns all the subclasses of a class, recursively.
+    """
+    ret = []
+    for subclass in cls.__subclasses__():
+        ret.append(subclass)
+        ret.extend(_get_subclasses(subclass))
+    return ret
+
+
+def warm_up(models=None):
+    """
+    Builds and caches everything that serializers otherwise set up the
+    first time they are used.
+
+    Renderer and parser classes, and the modules they import, are loaded
+    for every serializer class that has been defined, and the fields to
+    serialize are worked out for each model they may be used with.  Call
+    this once at startup, eg. before a pre-forking server forks its
+    workers, so that the workers share the cached state.
+
+    `models` defaults to every installed model.
+    """
+    if models is None:
+        from django.db.models import get_models
+        models = get_models(include_auto_created=True)
+
+    for serializer_class in set(_get_subclasses(BaseSerializer)):
+        try:
+            serializer = serializer_class()
+        except TypeError:
+            continue  # Requires arguments, so can't be warmed up generically
+        serializer.warm_up(models)
+
+
+class LazyRow(collections.Mapping):
+    """
+    A read-only mapping of an object's serialized field values, which only
+    serializes each field the first time it is read.
+    """
+    def __init__(self, serializer, obj, fields, values=None):
+        self.serializer = serializer
+        self.obj = obj
+        self.stack = serializer.stack[:]
+        self._fields = SortedDict([(serializer.get_field_key(field_name), (field_name, field))
+                                   for field_name, field in fields.items()])
+        self._values = {}
+        for field_name, value in (values or {}).items():
+            self._values[serializer.get_field_key(field_name)] = value
+
+    @property
+    def fields(self):
+        return SortedDict([(key, field) for key, (field_name, field) in self._fields.items()])
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        field_name, field = self._fields[key]
+
+        # Serialize the field as if the object were being converted now.
+        serializer = self.serializer
+        stack, serializer.stack = serializer.stack, self.stack[:]
+        try:
+            field.initialize(parent=serializer)
+            try:
+                value = field.field_to_native(self.obj, field_name)
+            except RecursionOccured:
+                field = serializer.get_fields(serialize=True, obj=self.obj, nested=False)[field_name]
+                value = field.field_to_native(self.obj, field_name)
+        finally:
+            serializer.stack = stack
+        if isinstance(value, DeferredValue):
+            value = value.get()
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '<LazyRow: %r>' % (self.obj,)
+
+
 class SerializerMetaclass(type):
     def __new__(cls, name, bases, attrs):
         attrs['base_fields'] = _get_declared_fields(bases, attrs)
@@ -72,18 +198,13 @@ class SerializerOptions(object):
     """
     def __init__(self, meta):
         self.nested = getattr(meta, 'nested', False)
+        self.chunk_size = getattr(meta, 'chunk_size', 100)
         self.fields = getattr(meta, 'fields', ())
         self.exclude = getattr(meta, 'exclude', ())
-        self.renderer_classes = getattr(meta, 'renderer_classes', {
-            'xml': XMLRenderer,
-            'json': JSONRenderer,
-            'yaml': YAMLRenderer,
-            'csv': CSVRenderer,
-            'html': HTMLRenderer,
-        })
-        self.parser_classes = getattr(meta, 'parser_classes', {
-            'json': JSONParser
-        })
+        self.renderer_classes = ClassRegistry(
+            getattr(meta, 'renderer_classes', DEFAULT_RENDERER_CLASSES))
+        self.parser_classes = ClassRegistry(
+            getattr(meta, 'parser_classes', DEFAULT_PARSER_CLASSES))
 
 
 class BaseSerializer(Field):
@@ -91,7 +212,7 @@ class BaseSerializer(Field):
         pass
 
     _options_class = SerializerOptions
-    _dict_class = SortedDictWithMetadata  # Set to unsorted dict for backwards compatability with unsorted implementations.
+    _dict_class = SortedRow  # Set to unsorted dict for backwards compatability with unsorted implementations.
 
     def __init__(self, source=None, readonly=False):
         super(BaseSerializer, self).__init__(source, readonly)
@@ -99,6 +220,22 @@ class BaseSerializer(Field):
         self.opts = self._options_class(self.Meta)
         self.parent = None
         self.root = None
+        self.context = {}
+        self._batched = {}
+        self.reset_caches()
+
+    def reset_caches(self, references=False, lazy=False):
+        """
+        Reset the state that is shared by all the objects converted during
+        a single call to `serialize`.
+        """
+        self._lazy = lazy
+        self._row_schemas = {}
+        self._converted = {}
+        self._converting = []
+        self._recursions = 0
+        self._natural_keys = {}
+        self._references = SortedDict() if references else None
 
     #####
     # Methods to determine which fields to use when (de)serializing objects.
@@ -152,6 +289,61 @@ class BaseSerializer(Field):
 
         return ret
 
+    def get_required_columns(self, obj):
+        """
+        Returns the names of the model fields that must be loaded from the
+        database in order to serialize the model instance `obj`, or None if
+        that can't be determined.
+        """
+        ret = []
+        fields = self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
+        for field_name, field in fields.items():
+            columns = field.required_columns(obj, field_name)
+            if columns is None:
+                return None
+            ret.extend(columns)
+        return ret
+
+    def restrict_queryset(self, queryset):
+        """
+        Returns the queryset, restricted with `.only()` to just the columns
+        needed for serialization.
+
+        Querysets that have already been evaluated, or that already use
+        `.only()`, `.defer()`, `.values()` or `.select_related()`, are
+        returned unchanged.
+        """
+        if (queryset._result_cache is not None or
+            isinstance(queryset, ValuesQuerySet) or
+            queryset.query.deferred_loading != (set(), True) or
+            queryset.query.select_related):
+            return queryset
+
+        model = queryset.model
+        columns = self.get_required_columns(model.__new__(model))
+        if columns is None:
+            return queryset
+        columns = set(columns)
+        if columns.issuperset([field.name for field in model._meta.fields]):
+            return queryset
+        return queryset.only(*columns)
+
+    def required_columns(self, obj, field_name):
+        if self.source == '*':
+            return self.get_required_columns(obj)
+        return super(BaseSerializer, self).required_columns(obj, field_name)
+
+    def warm_up(self, models):
+        """
+        Load the renderer and parser classes for every format, and any
+        modules they import lazily.  See `serializers.warm_up()`.
+        """
+        for registry in (self.opts.renderer_classes, self.opts.parser_classes):
+            for format in registry.keys():
+                cls = registry[format]
+                for name in getattr(cls, 'lazy_imports', ()):
+                    optional_import(name)
+
     #####
     # Field methods - used when the serializer class is itself used as a field.
 
@@ -186,20 +378,177 @@ class BaseSerializer(Field):
         self.stack.append(obj)
 
         ret = self._dict_class()
-        ret.fields = {}
+        keys = []
+        used_fields = []
 
+        batched = self._batched
         fields = self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
+        if (self.root or self)._lazy:
+            values = {}
+            for field_name in fields:
+                if batched and (id(obj), field_name) in batched:
+                    values[field_name] = batched.pop((id(obj), field_name))
+            return LazyRow(self, obj, fields, values)
+
         for field_name, field in fields.items():
             key = self.get_field_key(field_name)
             try:
-                value = field.field_to_native(obj, field_name)
+                if batched and (id(obj), field_name) in batched:
+                    value = batched.pop((id(obj), field_name))
+                else:
+                    value = field.field_to_native(obj, field_name)
             except RecursionOccured:
+                (self.root or self)._recursions += 1
                 field = self.get_fields(serialize=True, obj=obj, nested=False)[field_name]
                 value = field.field_to_native(obj, field_name)
             ret[key] = value
-            ret.fields[key] = field
+            keys.append(key)
+            used_fields.append(field)
+        ret.schema = self.get_row_schema(keys, used_fields)
+        return ret
+
+    def convert_objects(self, objs):
+        """
+        Convert an iterable of objects, a chunk of `chunk_size` objects at
+        a time, yielding the converted objects.
+
+        Any `DeferredValue` placeholders returned by fields are loaded
+        together once each chunk has been converted.  The related objects
+        converted by `convert_related_object`, and the natural keys of
+        related objects, are only cached for the chunk, so memory use
+        doesn't grow with the number of objects.
+        """
+        objs = iter(objs)
+        while True:
+            chunk = list(itertools.islice(objs, self.opts.chunk_size))
+            if not chunk:
+                return
+            if self.root is None:
+                self._converted = {}
+                self._natural_keys = {}
+            if not (self.root or self)._lazy:
+                # Lazy rows only compute the fields that are read.
+                self.prepare_batch(chunk)
+            created = DeferredValue.created
+            chunk = [self.to_native(obj) for obj in chunk]
+            if DeferredValue.created != created:
+                resolve_deferred(chunk)
+            for item in chunk:
+                yield item
+
+    def prepare_batch(self, objs):
+        """
+        Compute the values of any fields that implement
+        `field_to_native_batch` for a chunk of objects, ready for
+        `convert_object` to use.
+        """
+        self._batched = {}
+        groups = SortedDict()
+        for obj in objs:
+            if not (_is_protected_type(obj) or is_simple_callable(obj) or
+                    hasattr(obj, '__iter__')):
+                groups.setdefault(obj.__class__, []).append(obj)
+
+        children = SortedDict()
+        for group in groups.values():
+            fields = self.get_fields(serialize=True, obj=group[0], nested=self.opts.nested)
+            for field_name, field in fields.items():
+                if isinstance(field, BaseSerializer) and field.source == '*':
+                    # Serializes the same objects, so can batch them too.
+                    children.setdefault(field, []).extend(group)
+                    continue
+                values = field.field_to_native_batch(group, field_name)
+                if values is None:
+                    continue
+                for obj, value in zip(group, values):
+                    self._batched[(id(obj), field_name)] = value
+
+        for child, objs in children.items():
+            child.prepare_batch(objs)
+
+    def get_object_key(self, obj):
+        """
+        Returns a hashable key identifying a model instance, or None for
+        any other object.
+        """
+        if getattr(obj, 'pk', None) is None or not hasattr(obj, '_meta'):
+            return None
+        return (obj._meta.concrete_model, obj.pk)
+
+    def convert_related_object(self, obj):
+        """
+        Convert a related model instance, with each distinct instance only
+        being converted once for each chunk of objects.
+
+        A cached result is only reused where converting the instance again
+        would give the same result, so the output is unchanged.  Each
+        occurrence gets its own copy, so changing one doesn't change the
+        others.  If the
+        `references` option is used, the instance is instead added to the
+        references, and its key is returned.
+        """
+        key = self.get_object_key(obj)
+        root = self.root or self
+        if key is None or root._lazy:
+            return self.convert_object(obj)
+        if obj in self.stack:
+            raise RecursionOccured()
+
+        if root._references is not None:
+            reference = u'%s:%s' % (smart_unicode(obj._meta), obj.pk)
+            if reference not in root._references:
+                created = DeferredValue.created
+                ret = root._references[reference] = self.convert_object(obj)
+                if DeferredValue.created != created:
+                    resolve_deferred(ret)  # Not part of any chunk's rows
+            return reference
+
+        cache_key = (self.__class__, self.opts.nested, tuple(self.opts.fields),
+                     tuple(self.opts.exclude), key)
+        try:
+            ret, contained = root._converted[cache_key]
+        except KeyError:
+            pass
+        else:
+            # The cached result can't be used if any of the objects within
+            # it would be treated as recursion this time around.
+            stack = set([self.get_object_key(item) for item in self.stack])
+            if contained.isdisjoint(stack):
+                for outer in root._converting:
+                    outer.update(contained)
+                return _copy_native(ret)
+
+        contained = set([key])
+        recursions = root._recursions
+        root._converting.append(contained)
+        try:
+            ret = self.convert_object(obj)
+        finally:
+            root._converting.pop()
+        for outer in root._converting:
+            outer.update(contained)
+        if root._recursions == recursions:
+            root._converted[cache_key] = (_copy_native(ret), contained)
         return ret
 
+    def get_row_schema(self, keys, fields):
+        """
+        Return the `RowSchema` for a converted object.
+
+        Objects converted with the same keys and the same kinds of field
+        share a schema for the duration of a call to `serialize`.
+        """
+        schemas = (self.root or self)._row_schemas
+        cache_key = (self.__class__, tuple(keys), tuple([
+            (field.__class__, id(getattr(field, 'model_field', None)))
+            for field in fields
+        ]))
+        try:
+            return schemas[cache_key]
+        except KeyError:
+            schema = schemas[cache_key] = RowSchema(keys, fields)
+            return schema
+
     def restore_fields(self, data):
         """
         Core of deserialization, together with `restore_object`.
@@ -234,7 +583,9 @@ class BaseSerializer(Field):
             return dict([(key, self.to_native(val))
                          for (key, val) in obj.items()])
         elif hasattr(obj, '__iter__'):
-            return (self.to_native(item) for item in obj)
+            return self.convert_objects(obj)
+        elif self.parent is not None and self.source != '*':
+            return self.convert_related_object(obj)
         return self.convert_object(obj)
 
     def from_native(self, data):
@@ -252,15 +603,41 @@ class BaseSerializer(Field):
     def render(self, data, stream, format, **options):
         """
         Render primatives -> bytestream for serialization.
+
+        If the 'compress' option is set to 'gzip' or 'deflate', the output
+        is compressed as it is written to the stream.  For gzip, setting
+        'compress_threads' compresses blocks of output in parallel.
         """
+        compress = options.pop('compress', None)
+        threads = options.pop('compress_threads', None)
         renderer = self.opts.renderer_classes[format]()
-        return renderer.render(data, stream, **options)
+        if not compress:
+            return renderer.render(data, stream, **options)
+        if threads:
+            if compress not in (True, 'gzip'):
+                raise ValueError("'compress_threads' requires gzip compression")
+            stream = ParallelGzipWriter(stream, threads)
+        else:
+            stream = CompressedWriter(stream, compress)
+        try:
+            return renderer.render(data, stream, **options)
+        finally:
+            stream.close()
 
     def parse(self, stream, format, **options):
         """
         Parse bytestream -> primatives for deserialization.
+
+        Gzip input is detected and decompressed as it is read, unless the
+        'compress' option is False.  Deflate (zlib) input must be given the
+        'compress' option of 'deflate'.
         """
+        compress = options.pop('compress', None)
+        if compress or (compress is None and is_compressed(stream)):
+            stream = DecompressedReader(stream)
         parser = self.opts.parser_classes[format]()
+        if getattr(parser, 'uses_fields', False) and 'fields' not in options:
+            options['fields'] = self.get_fields(serialize=False, nested=self.opts.nested)
         return parser.parse(stream, **options)
 
     def serialize(self, format, obj, context=None, **options):
@@ -268,11 +645,34 @@ class BaseSerializer(Field):
         Perform serialization of objects into bytestream.
         First converts the objects into primatives,
         then renders primative types to bytestream.
+
+        If the 'references' option is set, each related object is output
+        once, in a 'references' dict, and is referred to by its key (eg.
+        'auth.user:1') wherever it occurs.  The output then takes the form
+        {'objects': ..., 'references': {...}}, with the objects converted
+        up front so that the references are complete.
+
+        If the 'lazy' option is set, the python format returns `LazyRow`
+        mappings, which only serialize each field when it is first read.
         """
         self.stack = []
         self.context = context or {}
-
+        references = options.pop('references', False)
+        lazy = options.pop('lazy', False)
+        if lazy and format != 'python':
+            raise ValueError("The 'lazy' option requires the 'python' format")
+        self.reset_caches(references, lazy)
+
+        if isinstance(obj, QuerySet):
+            obj = self.restrict_queryset(obj)
+        created = DeferredValue.created
         data = self.to_native(obj)
+        if DeferredValue.created != created and isinstance(data, dict):
+            resolve_deferred(data)
+        if references:
+            if isinstance(data, types.GeneratorType):
+                data = list(data)
+            data = SortedDict([('objects', data), ('references', self._references)])
         if format != 'python':
             stream = options.pop('stream', StringIO())
             self.render(data, stream, format, **options)
@@ -284,21 +684,46 @@ class BaseSerializer(Field):
             self.value = data
         return self.value
 
+    def serialize_pages(self, format, queryset, page_size=1000, after=None,
+                        context=None, **options):
+        """
+        Serialize a queryset one page at a time, yielding a tuple of
+        (rendered page, token) for each page.
+
+        Pages are fetched in primary key order, with `WHERE pk > token`
+        rather than an offset, so each page costs the same however far into
+        the queryset it is, and no cursor is held open between pages.
+        Pass a page's token as `after` to resume from the following page.
+        """
+        queryset = self.restrict_queryset(queryset.order_by('pk'))
+        while True:
+            if after is not None:
+                page = list(queryset.filter(pk__gt=after)[:page_size])
+            else:
+                page = list(queryset[:page_size])
+            if not page:
+                return
+            after = page[-1].pk
+            yield self.serialize(format, page, context, **options), after
+            if len(page) < page_size:
+                return
+
     def deserialize(self, format, stream_or_string, instance=None, context=None, **options):
         """
         Perform deserialization of bytestream into objects.
         First parses the bytestream into primative types,
         then converts primative types into objects.
+
+        Strings, buffers, memoryviews and mmap objects are parsed in place,
+        and regular files are memory-mapped.  Use `map_file` to deserialize
+        directly from a file path.
         """
         self.stack = []
         self.context = context or {}
         self.instance = instance
 
         if format != 'python':
-            if isinstance(stream_or_string, basestring):
-                stream = BytesIO(stream_or_string)
-            else:
-                stream = stream_or_string
+            stream = input_stream(stream_or_string)
             data = self.parse(stream, format, **options)
         else:
             data = stream_or_string
@@ -309,6 +734,10 @@ class Serializer(BaseSerializer):
     __metaclass__ = SerializerMetaclass
 
 
+# The serializable model fields for each model, see `get_model_fields()`.
+_model_fields = {}
+
+
 class ModelSerializerOptions(SerializerOptions):
     """
     Meta class options for ModelSerializer
@@ -316,6 +745,8 @@ class ModelSerializerOptions(SerializerOptions):
     def __init__(self, meta):
         super(ModelSerializerOptions, self).__init__(meta)
         self.model = getattr(meta, 'model', None)
+        if not hasattr(meta, 'renderer_classes'):
+            self.renderer_classes['npy'] = 'serializers.renderers.NumPyRenderer'
 
 
 class ModelSerializer(RelatedField, Serializer):
@@ -333,16 +764,8 @@ class ModelSerializer(RelatedField, Serializer):
         else:
             cls = self.opts.model
 
-        opts = cls._meta.concrete_model._meta
-        pk_field = opts.pk
-        while pk_field.rel:
-            pk_field = pk_field.rel.to._meta.pk
-        fields = [pk_field]
-        fields += [field for field in opts.fields if field.serialize]
-        fields += [field for field in opts.many_to_many if field.serialize]
-
         ret = SortedDict()
-        for model_field in fields:
+        for model_field in self.get_model_fields(cls):
             if model_field.rel and nested:
                 field = self.get_nested_field(model_field)
             elif model_field.rel:
@@ -353,6 +776,69 @@ class ModelSerializer(RelatedField, Serializer):
             ret[model_field.name] = field
         return ret
 
+    def get_model_fields(self, cls):
+        """
+        Returns the model fields that should be serialized for the model.
+        The result is cached for each model class.
+        """
+        model = cls._meta.concrete_model
+        try:
+            return _model_fields[model]
+        except KeyError:
+            pass
+
+        opts = model._meta
+        pk_field = opts.pk
+        while pk_field.rel:
+            pk_field = pk_field.rel.to._meta.pk
+        fields = [pk_field]
+        fields += [field for field in opts.fields if field.serialize]
+        fields += [field for field in opts.many_to_many if field.serialize]
+        _model_fields[model] = fields
+        return fields
+
+    def warm_up(self, models):
+        """
+        Also cache the fields of the serializer's model, or of every model
+        if it does not have one.
+        """
+        super(ModelSerializer, self).warm_up(models)
+        if self.opts.model:
+            models = [self.opts.model]
+        for model in models:
+            self.get_model_fields(model)
+            model._meta.get_all_field_names()  # Populates the field name cache
+
+    def get_queryset_fields(self, queryset):
+        """
+        Returns the fields that will be used for the objects in a queryset,
+        without fetching any of them.
+        """
+        obj = queryset.model.__new__(queryset.model)
+        return self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
+
+    def serialize(self, format, obj, context=None, **options):
+        """
+        Querysets are passed directly to renderers that read them in bulk,
+        such as NumPyRenderer, instead of being converted object by object.
+        """
+        renderer_class = self.opts.renderer_classes.get(format)
+        if (not getattr(renderer_class, 'renders_querysets', False) or
+            not isinstance(obj, QuerySet)):
+            return super(ModelSerializer, self).serialize(format, obj, context, **options)
+
+        self.stack = []
+        self.context = context or {}
+
+        stream = options.pop('stream', StringIO())
+        options['fields'] = self.get_queryset_fields(obj)
+        self.render(obj, stream, format, **options)
+        if hasattr(stream, 'getvalue'):
+            self.value = stream.getvalue()
+        else:
+            self.value = None
+        return self.value
+
     def get_nested_field(self, model_field):
         """
         Creates a default instance of a nested relational field.
@@ -1,11 +1,44 @@
+import cPickle
+import collections
 import datetime
+import gzip
+import copy
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
 from decimal import Decimal
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
-from django.db import models
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.serializers.base import DeserializationError, DeserializedObject
+from django.db import connection, connections, models
+from django.test import TestCase, TransactionTestCase
 from django.utils.datastructures import SortedDict
-from serializers import Serializer, ModelSerializer, FixtureSerializer
+from django.utils.unittest import skipUnless
+from serializers import Serializer, ModelSerializer, FixtureSerializer, warm_up
+from serializers import fixture_serializer, serializer as serializer_module
 from serializers.fields import Field, NaturalKeyRelatedField, PrimaryKeyRelatedField
+from serializers.loader import BulkLoader
+from serializers.fields import CharField, DateTimeField, FloatField, IntegerField
+from serializers.parsers import CSVParser, ColumnarJSONParser, JSONLinesParser
+from serializers.renderers import NumPyRenderer
+from serializers.utils import MessagePackEncoder, MessagePackDecoder
+from serializers.utils import DecompressedReader, ParallelGzipWriter, is_compressed, map_file
+from serializers.utils import BatchLoader
+from StringIO import StringIO
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ObjectSerializer has been removed from serializers
 # leaving it in the tests for the moment for more coverage.
@@ -46,9 +79,9 @@ class DepthOneObjectSerializer(ObjectSerializer):
 
 def expand(obj):
     """
-    Unroll any generators in returned object.
+    Unroll any generators or lazy mappings in returned object.
     """
-    if isinstance(obj, dict):
+    if isinstance(obj, collections.Mapping):
         ret = SortedDict()  # Retain original ordering
         for key, val in obj.items():
             ret[key] = expand(val)
@@ -416,6 +449,138 @@ class SerializerFieldTests(SerializationTestCase):
         self.assertEquals(CustomSerializer().serialize('python', self.obj).keys(), keys)
 
 
+class BatchFieldTests(SerializationTestCase):
+    """
+    Tests fields that compute their values for a chunk of objects at once.
+    """
+
+    def setUp(self):
+        self.objs = [Person('john', 'doe', 42), Person('jane', 'doe', 12),
+                     Person('anna', 'smith', 8)]
+
+    def test_field_to_native_batch(self):
+        calls = []
+
+        class AgeRankField(Field):
+            def field_to_native(self, obj, field_name):
+                raise AssertionError('Should use field_to_native_batch')
+
+            def field_to_native_batch(self, objs, field_name):
+                calls.append(len(objs))
+                ages = sorted([obj.age for obj in objs], reverse=True)
+                return [ages.index(obj.age) + 1 for obj in objs]
+
+        class CustomSerializer(Serializer):
+            first_name = Field()
+            rank = AgeRankField()
+
+            class Meta:
+                chunk_size = 2
+
+        data = CustomSerializer().serialize('python', self.objs)
+        self.assertEquals([item['rank'] for item in data], [1, 2, 1])
+        self.assertEquals(calls, [2, 1])
+
+    def test_field_to_native_batch_declined(self):
+        class ChildField(Field):
+            def field_to_native(self, obj, field_name):
+                return obj.is_child()
+
+            def field_to_native_batch(self, objs, field_name):
+                return None
+
+        class CustomSerializer(Serializer):
+            child = ChildField()
+
+        data = CustomSerializer().serialize('python', self.objs)
+        self.assertEquals([item['child'] for item in data], [False, True, True])
+
+
+class DeferredValueTests(SerializationTestCase):
+    """
+    Tests fields whose values are loaded together by a `BatchLoader`.
+    """
+
+    def get_serializer(self, loader):
+        class LookupPerson(Person):
+            def lookup(self):
+                return loader.load(self.first_name)
+
+        class CustomSerializer(Serializer):
+            first_name = Field()
+            nickname = Field(source='lookup')
+
+            class Meta:
+                chunk_size = 2
+
+        self.objs = [LookupPerson('john', 'doe', 42), LookupPerson('jane', 'doe', 12),
+                     LookupPerson('anna', 'smith', 8)]
+        return CustomSerializer()
+
+    def test_batch_function(self):
+        calls = []
+
+        def load_nicknames(keys):
+            calls.append(keys)
+            return [key[:2] for key in keys]
+
+        serializer = self.get_serializer(BatchLoader(batch_function=load_nicknames))
+        data = list(serializer.serialize('python', self.objs))
+        self.assertEquals([item['nickname'] for item in data], [u'jo', u'ja', u'an'])
+        self.assertEquals(calls, [['john', 'jane'], ['anna']])
+        self.assertEquals(serializer.serialize('python', self.objs[0])['nickname'], u'jo')
+        self.assertEquals(calls, [['john', 'jane'], ['anna'], ['john']])
+
+    def test_cache(self):
+        calls = []
+
+        def load_nicknames(keys):
+            calls.append(keys)
+            return [key[:2] for key in keys]
+
+        loader = BatchLoader(batch_function=load_nicknames, cache=True)
+        serializer = self.get_serializer(loader)
+        list(serializer.serialize('python', self.objs))
+        self.assertEquals(serializer.serialize('python', self.objs[0])['nickname'], u'jo')
+        self.assertEquals(calls, [['john', 'jane'], ['anna']])
+        self.assertEquals(sorted(loader.state.values), ['anna', 'jane', 'john'])
+
+    def test_shared_between_threads(self):
+        calls = []
+
+        def load_nicknames(keys):
+            calls.append(keys)
+            return [key.upper() for key in keys]
+
+        loader = BatchLoader(batch_function=load_nicknames)
+        deferred = loader.load('john')
+        pending = []
+
+        def other():
+            pending.append(list(loader.state.pending))
+            self.assertEquals(loader.get('jane'), u'JANE')
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        # The other thread neither saw nor loaded this thread's key.
+        self.assertEquals(pending, [[]])
+        self.assertEquals(deferred.get(), u'JOHN')
+        self.assertEquals(calls, [['jane'], ['john']])
+
+    def test_thread_pool(self):
+        loader = BatchLoader(function=lambda key: key.upper(), threads=2)
+        serializer = self.get_serializer(loader)
+        self.assertEquals(
+            serializer.serialize('json', self.objs),
+            '[{"first_name": "john", "nickname": "JOHN"}, '
+            '{"first_name": "jane", "nickname": "JANE"}, '
+            '{"first_name": "anna", "nickname": "ANNA"}]'
+        )
+        self.assertEquals(serializer.serialize('python', self.objs[0])['nickname'], u'JOHN')
+        self.assertEquals(loader.state.values, {})
+
+
 class NestedSerializationTests(SerializationTestCase):
     """
     Tests serialization of nested objects.
@@ -607,12 +772,111 @@ class TestSimpleModel(SerializationTestCase):
             expected
         )
 
+    def test_csv_deserialize(self):
+        lhs = get_deserialized(RaceEntry.objects.all(), format='csv', serializer=self.serializer)
+        rhs = get_deserialized(RaceEntry.objects.all())
+        self.assertTrue(deserialized_eq(lhs, rhs))
+
+    def test_msgpack_deserialize(self):
+        lhs = get_deserialized(RaceEntry.objects.all(), format='msgpack', serializer=self.serializer)
+        rhs = get_deserialized(RaceEntry.objects.all())
+        self.assertTrue(deserialized_eq(lhs, rhs))
+
+    def test_columnar(self):
+        expected = (
+            '{"columns": ["id", "name", "runner_number", "start_time", "finish_time"], '
+            '"data": {"id": [1], "name": ["John doe"], "runner_number": [6014], '
+            '"start_time": ["2012-04-30T09:00:00"], "finish_time": ["2012-04-30T12:25:00"]}}'
+        )
+        self.assertEquals(
+            self.serializer.serialize('columnar', RaceEntry.objects.all()),
+            expected
+        )
+
+    def test_columnar_rows(self):
+        expected = (
+            '{"columns": ["id", "name", "runner_number", "start_time", "finish_time"], '
+            '"data": [[1, "John doe", 6014, "2012-04-30T09:00:00", "2012-04-30T12:25:00"]]}'
+        )
+        output = self.serializer.serialize('columnar', RaceEntry.objects.all(), orient='rows')
+        self.assertEquals(output, expected)
+        self.assertEquals(ColumnarJSONParser().parse(StringIO(output))[0]['name'], u'John doe')
+
+    def test_columnar_deserialize(self):
+        lhs = get_deserialized(RaceEntry.objects.all(), format='columnar', serializer=self.serializer)
+        rhs = get_deserialized(RaceEntry.objects.all())
+        self.assertTrue(deserialized_eq(lhs, rhs))
+
+    def test_columnar_single_object(self):
+        obj = RaceEntry.objects.get()
+        expected = self.serializer.parse(StringIO(self.serializer.serialize('json', obj)), 'json')
+        for orient in ('columns', 'rows'):
+            output = self.serializer.serialize('columnar', obj, orient=orient)
+            self.assertTrue('"many": false' in output)
+            self.assertEquals(self.serializer.parse(StringIO(output), 'columnar'), expected)
+
+    def test_jsonl_dumpdata_deserialize(self):
+        lhs = get_deserialized(RaceEntry.objects.all(), format='jsonl', serializer=self.dumpdata)
+        rhs = get_deserialized(RaceEntry.objects.all())
+        self.assertTrue(deserialized_eq(lhs, rhs))
+
+    def test_compressed_dumpdata_deserialize(self):
+        lhs = get_deserialized(RaceEntry.objects.all(), serializer=self.dumpdata, compress='gzip')
+        rhs = get_deserialized(RaceEntry.objects.all())
+        self.assertTrue(deserialized_eq(lhs, rhs))
+
     def test_simple_dumpdata_fields(self):
         self.assertEquals(
             self.dumpdata.serialize('json', RaceEntry.objects.all(), fields=('name', 'runner_number')),
             serializers.serialize('json', RaceEntry.objects.all(), fields=('name', 'runner_number'))
         )
 
+    def test_dumpdata_fields_only_loads_columns(self):
+        connection.use_debug_cursor = True
+        try:
+            self.dumpdata.serialize('json', RaceEntry.objects.all(), fields=('name',))
+            sql = connection.queries[-1]['sql']
+        finally:
+            connection.use_debug_cursor = False
+        self.assertTrue('"name"' in sql)
+        self.assertFalse('"runner_number"' in sql)
+
+    def test_restrict_queryset(self):
+        class NameSerializer(ModelSerializer):
+            class Meta:
+                fields = ('id', 'name')
+
+        class MethodSerializer(ModelSerializer):
+            label = CharField(source='__unicode__')
+
+            class Meta:
+                fields = ('id', 'label')
+
+        queryset = NameSerializer().restrict_queryset(RaceEntry.objects.all())
+        self.assertEquals(queryset.query.deferred_loading, (set(['id', 'name']), False))
+        queryset = MethodSerializer().restrict_queryset(RaceEntry.objects.all())
+        self.assertEquals(queryset.query.deferred_loading, (set(), True))
+        self.assertEquals(
+            NameSerializer().serialize('python', RaceEntry.objects.all()),
+            [{'id': 1, 'name': u'John doe'}]
+        )
+
+    def test_serialize_pages(self):
+        for number in range(6015, 6020):
+            RaceEntry.objects.create(
+                name='Runner %d' % number,
+                runner_number=number,
+                start_time=datetime.datetime(year=2012, month=4, day=30, hour=9),
+                finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12)
+            )
+        pages = list(self.serializer.serialize_pages('csv', RaceEntry.objects.all(), page_size=4))
+        self.assertEquals([token for page, token in pages], [4, 6])
+        self.assertEquals(pages[1][0].count('\r\n'), 3)
+
+        pages = self.serializer.serialize_pages('python', RaceEntry.objects.all(),
+                                                page_size=4, after=4)
+        self.assertEquals([[row['id'] for row in page] for page, token in pages], [[5, 6]])
+
     def test_deserialize_fields(self):
         lhs = get_deserialized(RaceEntry.objects.all(), serializer=self.dumpdata, fields=('runner_number',))
         rhs = get_deserialized(RaceEntry.objects.all(), fields=('runner_number',))
@@ -633,12 +897,380 @@ class TestSimpleModel(SerializationTestCase):
         rhs = get_deserialized(RaceEntry.objects.all(), format='xml')
         self.assertTrue(deserialized_eq(lhs, rhs))
 
+    def test_rows_share_schema(self):
+        RaceEntry.objects.create(
+            name='Jane doe',
+            runner_number=6015,
+            start_time=datetime.datetime(year=2012, month=4, day=30, hour=9),
+            finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12, minute=5)
+        )
+        rows = list(self.serializer.serialize('python', RaceEntry.objects.all()))
+        self.assertTrue(rows[0].schema is rows[1].schema)
+        keys = ['id', 'name', 'runner_number', 'start_time', 'finish_time']
+        self.assertEquals(rows[1].keys(), keys)
+        self.assertEquals(rows[1].fields['name'].model_field.name, 'name')
+        duplicate = copy.copy(rows[1])
+        self.assertEquals(duplicate.keys(), keys)
+        self.assertEquals(duplicate['name'], 'Jane doe')
+
+    def test_row_extra_keys_keep_order(self):
+        class ExtraKeysSerializer(RaceEntrySerializer):
+            def convert_object(self, obj):
+                ret = super(ExtraKeysSerializer, self).convert_object(obj)
+                for key in ('zz', 'mm', 'aa', 'cc'):
+                    ret[key] = key
+                return ret
+
+        row = ExtraKeysSerializer().serialize('python', RaceEntry.objects.get())
+        keys = ['id', 'name', 'runner_number', 'start_time', 'finish_time', 'zz', 'mm', 'aa', 'cc']
+        self.assertEquals(row.keys(), keys)
+        del row['mm']
+        row['mm'] = 'mm'
+        self.assertEquals(row.keys()[-3:], ['aa', 'cc', 'mm'])
+        self.assertEquals(copy.copy(row).keys(), row.keys())
+
+    def test_rows_pickle(self):
+        row = self.serializer.serialize('python', RaceEntry.objects.get())
+        row['extra'] = True
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            duplicate = cPickle.loads(cPickle.dumps(row, protocol))
+            self.assertEquals(duplicate, row)
+            self.assertEquals(duplicate.keys(), row.keys())
+            self.assertEquals(duplicate.fields['name'].model_field.name, 'name')
+
+    def test_deserialize_buffer(self):
+        data = self.dumpdata.serialize('json', RaceEntry.objects.all())
+        for source in (memoryview(data), buffer(data), bytearray(data), data.decode('utf-8')):
+            lhs = [obj.object for obj in self.dumpdata.deserialize('json', source)]
+            self.assertEquals(lhs[0].name, 'John doe')
+
+    def test_deserialize_mapped_file(self):
+        data = self.dumpdata.serialize('xml', RaceEntry.objects.all())
+        with tempfile.TemporaryFile() as temp:
+            temp.write(data)
+            temp.seek(0)
+            mapping = mmap.mmap(temp.fileno(), 0, access=mmap.ACCESS_READ)
+            objects = list(self.dumpdata.deserialize('xml', mapping))
+            self.assertEquals(objects[0].object.runner_number, 6014)
+            mapping.close()
+            objects = list(self.dumpdata.deserialize('xml', temp))
+            self.assertEquals(objects[0].object.runner_number, 6014)
+
+    def test_map_file(self):
+        data = self.dumpdata.serialize('jsonl', RaceEntry.objects.all())
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.write(data)
+            temp.flush()
+            objects = list(self.dumpdata.deserialize('jsonl', map_file(temp.name)))
+            self.assertEquals(objects[0].object.name, 'John doe')
+
     # def test_xml_parsing(self):
     #     data = self.dumpdata.serialize('xml', RaceEntry.objects.all())
     #     object = list(self.dumpdata.deserialize('xml', data))[0].object
     #     print repr((object.name, object.runner_number, object.start_time, object.finish_time))
 
 
+class CSVParserTests(SerializationTestCase):
+    def setUp(self):
+        class RaceSerializer(Serializer):
+            name = CharField()
+            runner_number = IntegerField()
+            time = FloatField()
+            start_time = DateTimeField()
+
+        self.serializer = RaceSerializer()
+        self.stream = (
+            "name,runner_number,time,start_time\r\n"
+            "John doe,6014,3.5,2012-04-30 09:00:00\r\n"
+            "Jane doe,6015,4.25,2012-04-30 09:05:00\r\n"
+        )
+
+    def test_typed_columns(self):
+        expected = [
+            {
+                'name': u'John doe',
+                'runner_number': 6014,
+                'time': 3.5,
+                'start_time': datetime.datetime(2012, 4, 30, 9, 0)
+            }, {
+                'name': u'Jane doe',
+                'runner_number': 6015,
+                'time': 4.25,
+                'start_time': datetime.datetime(2012, 4, 30, 9, 5)
+            }
+        ]
+        parsed = CSVParser().parse(StringIO(self.stream), fields={
+            'runner_number': IntegerField(),
+            'time': FloatField(),
+            'start_time': DateTimeField(),
+        })
+        self.assertEquals(list(parsed), expected)
+
+    def test_model_columns(self):
+        serializer = RaceEntrySerializer()
+        fields = serializer.get_fields(serialize=False)
+        parser = CSVParser()
+        for name in ('id', 'runner_number', 'start_time', 'finish_time'):
+            self.assertTrue(parser.get_column_converter(fields[name]) is not None, name)
+        self.assertEquals(parser.get_column_converter(fields['name']), None)
+        stream = (
+            "id,name,runner_number,start_time,finish_time\r\n"
+            "1,John doe,6014,2012-04-30 09:00:00,2012-04-30 12:25:00\r\n"
+        )
+        self.assertEquals(list(serializer.parse(StringIO(stream), 'csv')), [{
+            'id': 1,
+            'name': u'John doe',
+            'runner_number': 6014,
+            'start_time': datetime.datetime(2012, 4, 30, 9, 0),
+            'finish_time': datetime.datetime(2012, 4, 30, 12, 25),
+        }])
+
+    def test_chunked_rows(self):
+        output = self.serializer.deserialize('csv', self.stream, chunk_size=1)
+        self.assertEquals([item['runner_number'] for item in output], [6014, 6015])
+
+    def test_invalid_column_value(self):
+        stream = self.stream.replace('6015', 'abc')
+        output = self.serializer.deserialize('csv', stream)
+        self.assertRaises(ValidationError, list, output)
+
+
+class JSONLinesTests(SerializationTestCase):
+    def test_one_object_per_line(self):
+        expected = '{"a": 1, "b": "foo", "c": true}\n{"a": 1, "b": "foo", "c": true}\n'
+        output = ObjectSerializer().serialize('jsonl', [ExampleObject(), ExampleObject()])
+        self.assertEquals(output, expected)
+
+    def test_offset(self):
+        stream = StringIO('{"a": 1}\n\n{"a": 2}\n{"a": 3}\n')
+        self.assertEquals(list(JSONLinesParser().parse(stream, offset=2, chunk_size=1)), [{'a': 2}, {'a': 3}])
+
+    def test_invalid_line(self):
+        stream = StringIO('{"a": 1}\n{"a": \n')
+        self.assertRaises(DeserializationError, list, JSONLinesParser().parse(stream))
+
+
+class CompressionTests(SerializationTestCase):
+    def setUp(self):
+        self.objs = [Person('john', 'doe', 42), Person('jane', 'doe', 37)]
+        self.expected = ObjectSerializer().serialize('json', self.objs)
+
+    def test_gzip(self):
+        output = ObjectSerializer().serialize('json', self.objs, compress='gzip')
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(output)).read(), self.expected)
+
+    def test_deflate(self):
+        output = ObjectSerializer().serialize('json', self.objs, compress='deflate')
+        self.assertEquals(zlib.decompress(output), self.expected)
+
+    def test_transparent_decompression(self):
+        output = ObjectSerializer().serialize('jsonl', self.objs, compress='gzip')
+        self.assertEquals(
+            list(ObjectSerializer().parse(StringIO(output), 'jsonl')),
+            list(ObjectSerializer().parse(StringIO(self.expected), 'json'))
+        )
+
+    def test_explicit_deflate_decompression(self):
+        output = ObjectSerializer().serialize('jsonl', self.objs, compress='deflate')
+        self.assertEquals(
+            list(ObjectSerializer().parse(StringIO(output), 'jsonl', compress='deflate')),
+            list(ObjectSerializer().parse(StringIO(self.expected), 'json'))
+        )
+
+    def test_text_is_not_detected_as_deflate(self):
+        # "H," and "hb" happen to be valid zlib headers.
+        for text in ('H,W\r\n1,2\r\n', 'hb'):
+            self.assertFalse(is_compressed(StringIO(text)))
+        self.assertEquals(
+            list(Serializer().parse(StringIO('H,W\r\n1,2\r\n'), 'csv')),
+            [{'H': '1', 'W': '2'}]
+        )
+
+    def test_multi_member_gzip(self):
+        output = ''.join(
+            ObjectSerializer().serialize('jsonl', obj, compress='gzip') for obj in self.objs
+        )
+        reader = DecompressedReader(StringIO(output), block_size=7)
+        self.assertEquals(len(list(reader)), 2)
+
+    def test_parallel_gzip(self):
+        output = StringIO()
+        writer = ParallelGzipWriter(output, threads=2, block_size=16)
+        writer.write(self.expected)
+        writer.close()
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(output.getvalue())).read(), self.expected)
+        self.assertEquals(
+            list(ObjectSerializer().parse(StringIO(output.getvalue()), 'json')),
+            list(ObjectSerializer().parse(StringIO(self.expected), 'json'))
+        )
+
+    def test_parallel_gzip_serialize(self):
+        output = ObjectSerializer().serialize('json', self.objs, compress='gzip', compress_threads=2)
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(output)).read(), self.expected)
+
+    def test_disable_detection(self):
+        output = ObjectSerializer().serialize('json', self.objs, compress='gzip')
+        self.assertRaises(DeserializationError, ObjectSerializer().parse,
+                          StringIO(output), 'json', compress=False)
+
+
+class MessagePackTests(SerializationTestCase):
+    def setUp(self):
+        self.obj = SortedDict([
+            ('b', u'caf\xe9'),
+            ('a', [1, -1, 200, -200, 70000, 2 ** 40, -2 ** 40, 1.5, None, True]),
+            ('c', datetime.datetime(2012, 4, 30, 9, 0)),
+            ('d', Decimal('0.25')),
+            ('e', 'x' * 40),
+        ])
+        self.expected = {
+            'b': u'caf\xe9',
+            'a': [1, -1, 200, -200, 70000, 2 ** 40, -2 ** 40, 1.5, None, True],
+            'c': u'2012-04-30T09:00:00',
+            'd': u'0.25',
+            'e': u'x' * 40,
+        }
+
+    def test_roundtrip(self):
+        data = MessagePackEncoder().encode(self.obj)
+        self.assertEquals(list(MessagePackDecoder(StringIO(data), block_size=3)), [self.expected])
+
+    def test_field_order(self):
+        data = MessagePackEncoder().encode(self.obj)
+        self.assertEquals(data[:3], '\x85\xa1b')
+
+    def test_stream_of_objects(self):
+        data = ObjectSerializer().serialize('msgpack', [ExampleObject(), ExampleObject()])
+        expected = {'a': 1, 'b': 'foo', 'c': True}
+        self.assertEquals(list(ObjectSerializer().parse(StringIO(data), 'msgpack')), [expected, expected])
+
+    def test_single_object(self):
+        data = ObjectSerializer().serialize('msgpack', ExampleObject())
+        expected = {'a': 1, 'b': 'foo', 'c': True}
+        self.assertEquals(ObjectSerializer().parse(StringIO(data), 'msgpack', many=False), expected)
+        self.assertEquals(list(ObjectSerializer().parse(StringIO(data), 'msgpack')), [expected])
+        data = ObjectSerializer().serialize('msgpack', [ExampleObject(), ExampleObject()])
+        self.assertRaises(DeserializationError, ObjectSerializer().parse, StringIO(data), 'msgpack', many=False)
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_wire_compatible(self):
+        packer = msgpack.Packer(default=MessagePackEncoder().default, use_bin_type=False)
+        self.assertEquals(MessagePackEncoder().encode(self.obj), packer.pack(self.obj))
+        unpacker = msgpack.Unpacker(StringIO(MessagePackEncoder().encode(self.obj)), raw=False)
+        self.assertEquals(list(unpacker), [self.expected])
+
+
+@skipUnless(numpy, 'numpy is not installed')
+class NumPyRendererTests(SerializationTestCase):
+    def setUp(self):
+        class RaceTimesSerializer(ModelSerializer):
+            class Meta:
+                model = RaceEntry
+                fields = ('id', 'runner_number', 'start_time')
+
+        self.serializer = RaceTimesSerializer()
+        for number in (6014, 6015, 6016):
+            RaceEntry.objects.create(
+                name='John doe',
+                runner_number=number,
+                start_time=datetime.datetime(year=2012, month=4, day=30, hour=9),
+                finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12, minute=25)
+            )
+
+    def test_to_array(self):
+        fields = self.serializer.get_queryset_fields(RaceEntry.objects.all())
+        array = NumPyRenderer().to_array(RaceEntry.objects.all(), fields=fields, chunk_size=2)
+        self.assertEquals(array.dtype.names, ('id', 'runner_number', 'start_time'))
+        self.assertEquals(list(array['runner_number']), [6014, 6015, 6016])
+        self.assertEquals(array['start_time'][0], numpy.datetime64('2012-04-30T09:00:00'))
+
+    def test_npy(self):
+        output = self.serializer.serialize('npy', RaceEntry.objects.all())
+        array = numpy.load(StringIO(output))
+        self.assertEquals(list(array['id']), [1, 2, 3])
+
+    def test_unsupported_field(self):
+        self.assertRaises(ValueError, RaceEntrySerializer().serialize, 'npy', RaceEntry.objects.all())
+
+
+class ImportTests(SerializationTestCase):
+    """
+    Renderers, parsers and their optional codecs should only be imported
+    once a format that uses them is needed.
+    """
+    script = """
+import sys
+import django.db.models
+before = set(sys.modules)
+from serializers import Serializer, FixtureSerializer
+Serializer().serialize('json', {'a': 1})
+modules = set(sys.modules) - before
+for serializer in (Serializer(), FixtureSerializer()):
+    for format in serializer.opts.renderer_classes.keys():
+        serializer.opts.renderer_classes[format]
+    for format in serializer.opts.parser_classes.keys():
+        serializer.opts.parser_classes[format]
+print ' '.join(sorted(modules))
+"""
+    # Times importing the package and rendering JSON, either as it is, or
+    # importing every renderer, parser and codec up front, as before they
+    # were imported lazily.
+    timing_script = """
+import sys, time
+import django.db.models
+start = time.time()
+from serializers import Serializer
+if sys.argv[1] == 'eager':
+    import serializers.renderers, serializers.parsers
+    for name in %r:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+Serializer().serialize('json', {'a': 1})
+print time.time() - start
+"""
+    # NB: yaml is not included, as `django.core.serializers` imports it.
+    deferred = ('csv', 'xml.dom.pulldom', 'numpy', 'msgpack',
+                'multiprocessing.pool', 'serializers.parsers')
+
+    def run_script(self, script, *args):
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.Popen([sys.executable, '-c', script] + list(args),
+                                cwd=cwd, env=os.environ,
+                                stdout=subprocess.PIPE).communicate()[0]
+
+    def test_json_only_imports(self):
+        # Every format must still resolve, or the script fails and prints nothing.
+        modules = self.run_script(self.script).split()
+        self.assertTrue('serializers.renderers' in modules)
+        for name in self.deferred:
+            self.assertFalse(name in modules, '%s was imported' % name)
+
+    def test_import_time(self):
+        """
+        Report the best of three import times, against importing everything
+        up front.  The gain depends on the machine and on which optional
+        codecs are installed, so it is reported rather than asserted.
+        """
+        script = self.timing_script % (self.deferred,)
+        timings = {}
+        for mode in ('lazy', 'eager'):
+            timings[mode] = min([float(self.run_script(script, mode)) for i in range(3)])
+        sys.stderr.write('\nImport and first JSON render: %.1fms lazy, %.1fms eager\n' % (
+            timings['lazy'] * 1000, timings['eager'] * 1000))
+        self.assertTrue(timings['lazy'] > 0 and timings['eager'] > 0)
+
+    def test_warm_up(self):
+        serializer_module._model_fields.clear()
+        fixture_serializer._fixture_fields.clear()
+        warm_up()
+        self.assertTrue('xml.dom.pulldom' in sys.modules)
+        self.assertTrue(RaceEntry in serializer_module._model_fields)
+        self.assertTrue(RaceEntry in fixture_serializer._fixture_fields)
+        self.assertTrue(Profile in serializer_module._model_fields)
+
+
 class TestNullPKModel(SerializationTestCase):
     def setUp(self):
         self.dumpdata = FixtureSerializer()
@@ -740,6 +1372,44 @@ class TestModelInheritance(SerializationTestCase):
         rhs = get_deserialized(PremiumAccount.objects.all())
         self.assertTrue(deserialized_eq(lhs, rhs))
 
+    def test_bulk_load_child_model(self):
+        objs = [PremiumAccount(pk=pk, points=pk, company='Company %d' % pk,
+                               date_upgraded=datetime.datetime(year=2012, month=5, day=pk))
+                for pk in (2, 3, 4)]
+        # One insert into each of the parent and child tables.
+        with self.assertNumQueries(2):
+            self.assertEquals(BulkLoader().load(objs), 3)
+        self.assertEquals(
+            [(account.pk, account.points, account.company, account.date_upgraded.day)
+             for account in PremiumAccount.objects.filter(pk__gt=1)],
+            [(2, 2, u'Company 2', 2), (3, 3, u'Company 3', 3), (4, 4, u'Company 4', 4)]
+        )
+
+    def test_bulk_load_resets_parent_sequences(self):
+        reset = []
+
+        class RecordingBulkLoader(BulkLoader):
+            def reset_sequences(self, tables):
+                reset.extend(tables)
+
+        RecordingBulkLoader().load([
+            PremiumAccount(pk=2, points=2, company='Company 2',
+                           date_upgraded=datetime.datetime(year=2012, month=5, day=2))
+        ])
+        self.assertEquals(reset, [Account, PremiumAccount])
+
+    def test_bulk_load_dumpdata(self):
+        objs = list(Account.objects.all()) + list(PremiumAccount.objects.all())
+        data = self.dumpdata.serialize('json', objs)
+        Account.objects.all().delete()
+        BulkLoader().load(self.dumpdata.deserialize('json', data))
+        self.assertEquals(Account.objects.count(), 1)
+        self.assertEquals(
+            self.dumpdata.serialize('json', list(Account.objects.all()) +
+                                    list(PremiumAccount.objects.all())),
+            data
+        )
+
     # TODO:
     # def test_dumpdata_deserialize_xml(self):
     #     lhs = get_deserialized(PremiumAccount.objects.all(), format='xml', serializer=self.dumpdata)
@@ -832,6 +1502,32 @@ class TestNaturalKey(SerializationTestCase):
             serializers.serialize('xml', Pet.objects.all(), use_natural_keys=True)
         )
 
+    def test_naturalkey_dumpdata_batched(self):
+        """
+        Ensure that the related objects are loaded with one query, and
+        that each natural key is only computed once.
+        """
+        calls = []
+        natural_key = PetOwner.natural_key
+        def counted_natural_key(owner):
+            calls.append(owner.pk)
+            return natural_key(owner)
+
+        PetOwner.natural_key = counted_natural_key
+        try:
+            with self.assertNumQueries(2):
+                FixtureSerializer().serialize('json', Pet.objects.all(), use_natural_keys=True)
+            self.assertEquals(calls, [1])
+            # The natural keys are only cached for each chunk.
+            serializer = FixtureSerializer()
+            serializer.opts.chunk_size = 1
+            with self.assertNumQueries(3):
+                serializer.serialize('json', Pet.objects.all(), use_natural_keys=True)
+        finally:
+            PetOwner.natural_key = natural_key
+        self.assertEquals(calls, [1, 1, 1])
+        self.assertEquals(serializer._natural_keys, {(PetOwner, 1): (u'joe', u'adams')})
+
     def test_naturalkey(self):
         """
         Ensure that we can use NaturalKeyRelatedField to represent foreign
@@ -1145,6 +1841,82 @@ class TestFKModel(SerializationTestCase):
             expected
         )
 
+    def test_reverse_fk_prefetched(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = ModelSerializer()
+
+        owner = Owner.objects.create(email='jane@example.com')
+        Vehicle.objects.create(owner=owner, licence='',
+                               date_of_manufacture=datetime.date(day=1, month=1, year=2000))
+        with self.assertNumQueries(2):
+            data = OwnerSerializer().serialize('python', Owner.objects.all())
+            self.assertEquals([[vehicle['id'] for vehicle in item['vehicles']] for item in data],
+                              [[1, 2], [3]])
+
+    def test_reverse_fk_limit(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = PrimaryKeyRelatedField(limit=1, order_by=['-licence'])
+
+        owner = Owner.objects.create(email='jane@example.com')
+        for licence in ('A', 'C', 'B'):
+            Vehicle.objects.create(owner=owner, licence=licence,
+                                   date_of_manufacture=datetime.date(day=1, month=1, year=2000))
+        with self.assertNumQueries(2):
+            data = OwnerSerializer().serialize('python', Owner.objects.all())
+            self.assertEquals([item['vehicles'] for item in data], [[1], [4]])
+        self.assertEquals(
+            OwnerSerializer().serialize('python', owner)['vehicles'],
+            [4]
+        )
+
+    def test_reverse_fk_limit_keeps_manager(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = PrimaryKeyRelatedField(limit=1, order_by=['-licence'])
+
+        for licence in ('A', 'C'):
+            Vehicle.objects.create(owner_id=1, licence=licence,
+                                   date_of_manufacture=datetime.date(day=1, month=1, year=2000))
+        owners = list(Owner.objects.all())
+        data = list(OwnerSerializer().serialize('python', owners))
+        self.assertEquals([item['vehicles'] for item in data], [[1]])
+        self.assertEquals(sorted(vehicle.pk for vehicle in owners[0].vehicles.all()), [1, 2, 3, 4])
+        # Serializing again doesn't reuse the prefetched objects.
+        Vehicle.objects.filter(pk=1).delete()
+        self.assertEquals(list(OwnerSerializer().serialize('python', owners))[0]['vehicles'], [4])
+
+    def test_reverse_fk_limit_fallback(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = PrimaryKeyRelatedField(limit=1, order_by=['owner__email', '-licence'])
+
+        class RandomOwnerSerializer(ModelSerializer):
+            vehicles = PrimaryKeyRelatedField(limit=1, order_by=['?'])
+
+        owner = Owner.objects.create(email='jane@example.com')
+        for licence in ('A', 'C', 'B'):
+            Vehicle.objects.create(owner=owner, licence=licence,
+                                   date_of_manufacture=datetime.date(day=1, month=1, year=2000))
+        # Orderings that can't be written as columns of the related table
+        # are applied to a query for each object.
+        with self.assertNumQueries(3):
+            data = OwnerSerializer().serialize('python', Owner.objects.all())
+            self.assertEquals([item['vehicles'] for item in data], [[1], [4]])
+        with self.assertNumQueries(3):
+            data = RandomOwnerSerializer().serialize('python', Owner.objects.all())
+            self.assertEquals([len(item['vehicles']) for item in data], [1, 1])
+
+    def test_reverse_fk_limit_unsupported_vendor(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = PrimaryKeyRelatedField(limit=1, order_by=['-licence'])
+
+        wrapper = connections['default']
+        wrapper.vendor = 'oracle'
+        try:
+            with self.assertNumQueries(2):
+                data = OwnerSerializer().serialize('python', Owner.objects.all())
+                self.assertEquals([item['vehicles'] for item in data], [[1]])
+        finally:
+            del wrapper.vendor
+
     def test_reverse_fk_nested(self):
         class OwnerSerializer(ModelSerializer):
             vehicles = ModelSerializer()
@@ -1171,6 +1943,90 @@ class TestFKModel(SerializationTestCase):
             expected
         )
 
+    def test_fk_nested_shared(self):
+        rows = list(self.nested_model.serialize('python', Vehicle.objects.all()))
+        self.assertEquals(rows[1]['owner'], {'id': 1, 'email': u'tom@example.com'})
+        self.assertFalse(rows[0]['owner'] is rows[1]['owner'])
+        rows[0]['owner']['email'] = u'changed@example.com'
+        self.assertEquals(rows[1]['owner'], {'id': 1, 'email': u'tom@example.com'})
+
+    def test_fk_nested_cache_per_chunk(self):
+        owner = Owner.objects.create(email='jane@example.com')
+        Vehicle.objects.create(owner=owner, licence='',
+                               date_of_manufacture=datetime.date(day=1, month=1, year=2000))
+        serializer = NestedVehicleSerializer()
+        serializer.opts.chunk_size = 1
+        rows = list(serializer.serialize('python', Vehicle.objects.all()))
+        self.assertEquals([row['owner']['id'] for row in rows], [1, 1, 2])
+        self.assertEquals(len(serializer._converted), 1)
+
+    def test_fk_nested_recursion_not_shared(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = NestedVehicleSerializer()
+
+            class Meta:
+                nested = True
+
+        data = OwnerSerializer().serialize('python', Owner.objects.get(id=1))
+        # The owner is recursion within its own vehicles, so stays flat.
+        self.assertEquals([vehicle['owner'] for vehicle in data['vehicles']], [1, 1])
+
+    def test_fk_nested_lazy(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = NestedVehicleSerializer()
+
+            class Meta:
+                nested = True
+
+        for serializer, obj in ((self.nested_model, Vehicle.objects.get(id=1)),
+                                (OwnerSerializer(), Owner.objects.get(id=1))):
+            expected = serializer.serialize('python', obj)
+            self.assertEquals(serializer.serialize('python', obj, lazy=True), expected)
+
+    def test_lazy_reads_only_accessed_fields(self):
+        class FailingField(Field):
+            def field_to_native(self, obj, field_name):
+                raise AssertionError('Should not be serialized')
+
+        class LazyVehicleSerializer(NestedVehicleSerializer):
+            owner = FailingField()
+
+        rows = list(LazyVehicleSerializer().serialize('python', Vehicle.objects.all(), lazy=True))
+        self.assertEquals([row['licence'] for row in rows], [u'DJANGO42', u''])
+        self.assertTrue('owner' in rows[0])
+        self.assertRaises(ValueError, LazyVehicleSerializer().serialize,
+                          'json', Vehicle.objects.all(), lazy=True)
+
+    def test_lazy_does_not_batch(self):
+        class OwnerSerializer(ModelSerializer):
+            vehicles = ModelSerializer()
+
+        with self.assertNumQueries(1):
+            rows = list(OwnerSerializer().serialize('python', Owner.objects.all(), lazy=True))
+            self.assertEquals([row['email'] for row in rows], [u'tom@example.com'])
+        with self.assertNumQueries(1):
+            self.assertEquals([vehicle['id'] for vehicle in rows[0]['vehicles']], [1, 2])
+
+    def test_fk_references(self):
+        expected = (
+            '{"objects": ['
+            '{"id": 1, "owner": "serializers.owner:1", "licence": "DJANGO42", '
+            '"date_of_manufacture": "2005-06-06"}, '
+            '{"id": 2, "owner": "serializers.owner:1", "licence": "", '
+            '"date_of_manufacture": "1990-08-08"}], '
+            '"references": {"serializers.owner:1": {"id": 1, "email": "tom@example.com"}}}'
+        )
+        self.assertEquals(
+            self.nested_model.serialize('json', Vehicle.objects.all(), references=True),
+            expected
+        )
+
+    def test_fk_references_python(self):
+        data = self.nested_model.serialize('python', Vehicle.objects.all(), references=True)
+        self.assertEquals(data['references'].keys(), [u'serializers.owner:1'])
+        self.assertEquals([row['owner'] for row in data['objects']],
+                          [u'serializers.owner:1', u'serializers.owner:1'])
+
 
 class Author(models.Model):
     name = models.CharField(max_length=100)
@@ -1231,6 +2087,41 @@ class TestManyToManyModel(SerializationTestCase):
             serializers.serialize('json', Author.objects.all())
         )
 
+    def test_m2m_prefetched(self):
+        with self.assertNumQueries(2):
+            self.dumpdata.serialize('json', Book.objects.all())
+        with self.assertNumQueries(2):
+            self.flat_model.serialize('json', Book.objects.all())
+
+    def test_m2m_limit(self):
+        class AuthorSerializer(ModelSerializer):
+            books = PrimaryKeyRelatedField(limit=1, order_by=['title'])
+
+        with self.assertNumQueries(2):
+            data = AuthorSerializer().serialize('python', Author.objects.all())
+            self.assertEquals([item['books'] for item in data],
+                              [[self.cookbook.pk], [self.otherbook.pk]])
+
+        class LimitedBookSerializer(ModelSerializer):
+            authors = PrimaryKeyRelatedField(limit=1, order_by=['-name'])
+
+        with self.assertNumQueries(2):
+            data = LimitedBookSerializer().serialize('python', Book.objects.all())
+            self.assertEquals([item['authors'] for item in data],
+                              [[self.mark.pk], [self.mark.pk]])
+
+    def test_m2m_bulk_load(self):
+        objs = list(Author.objects.all()) + list(Book.objects.all())
+        data = self.dumpdata.serialize('json', objs)
+        Book.objects.all().delete()
+        Author.objects.all().delete()
+        BulkLoader().load(self.dumpdata.deserialize('json', data))
+        self.assertEquals(
+            self.dumpdata.serialize('json', list(Author.objects.all()) +
+                                    list(Book.objects.all())),
+            data
+        )
+
     def test_m2m_dumpdata_yaml(self):
         self.assertEquals(
             self.dumpdata.serialize('yaml', Book.objects.all()),
@@ -1331,6 +2222,188 @@ class TestManyToManyThroughModel(SerializationTestCase):
         )
 
 
+class TaggedItem(models.Model):
+    tag = models.SlugField()
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey()
+
+
+class Bookmark(models.Model):
+    url = models.CharField(max_length=100)
+    tags = generic.GenericRelation(TaggedItem)
+
+
+class TestGenericRelations(SerializationTestCase):
+    """
+    Test generic foreign keys and generic relations.
+    """
+    def setUp(self):
+        for url in ('http://example.com', 'http://example.org'):
+            bookmark = Bookmark.objects.create(url=url)
+            for tag in ('django', 'python', 'serializers'):
+                TaggedItem.objects.create(tag=tag, content_object=bookmark)
+        owner = Owner.objects.create(email='tom@example.com')
+        TaggedItem.objects.create(tag='owner', content_object=owner)
+        ContentType.objects.clear_cache()
+
+    def test_generic_foreign_key_batched(self):
+        class TaggedItemSerializer(ModelSerializer):
+            content_type = ModelSerializer()
+            content_object = ModelSerializer()
+
+        # The tags, the two content types and one query per content type.
+        with self.assertNumQueries(5):
+            data = TaggedItemSerializer().serialize('python', TaggedItem.objects.all())
+            self.assertEquals(
+                [(item['content_type']['model'], item['content_object']['id']) for item in data],
+                [(u'bookmark', 1)] * 3 + [(u'bookmark', 2)] * 3 + [(u'owner', 1)]
+            )
+
+    def test_generic_relation_limit(self):
+        class BookmarkSerializer(ModelSerializer):
+            tags = PrimaryKeyRelatedField(limit=2, order_by=['-tag'])
+
+        # The bookmarks, their content type and the limited tags.
+        with self.assertNumQueries(3):
+            data = BookmarkSerializer().serialize('python', Bookmark.objects.all())
+            self.assertEquals([item['tags'] for item in data], [[3, 2], [6, 5]])
+
+
+class TreeNode(models.Model):
+    name = models.CharField(max_length=100)
+    parent = models.ForeignKey('self', null=True, related_name='children')
+
+
+class Team(models.Model):
+    name = models.CharField(max_length=100)
+    captain = models.ForeignKey('Player', null=True, related_name='+')
+
+
+class Player(models.Model):
+    name = models.CharField(max_length=100)
+    team = models.ForeignKey(Team)
+
+
+class ConcurrentBulkLoaderTests(TransactionTestCase):
+    def test_levels_are_inserted_on_worker_connections(self):
+        inserted = []
+        main_thread = threading.current_thread()
+
+        class RecordingBulkLoader(BulkLoader):
+            def insert_table(self, args):
+                model, objs = args
+                inserted.append((model, threading.current_thread() is not main_thread))
+
+        owner = Owner(pk=1, email='tom@example.com')
+        vehicles = [Vehicle(pk=pk, owner_id=1, licence='DJANGO%d' % pk,
+                            date_of_manufacture=datetime.date(day=6, month=6, year=2005))
+                    for pk in (1, 2)]
+        wrapper = connections['default']
+        wrapper.vendor = 'postgresql'
+        try:
+            loader = RecordingBulkLoader(threads=4)
+            self.assertTrue(loader.is_concurrent())
+            # Nothing is inserted on the main connection.
+            with self.assertNumQueries(0):
+                loader.load(vehicles + [owner])
+        finally:
+            del wrapper.vendor
+        self.assertEquals(inserted, [(Owner, True), (Vehicle, True)])
+
+
+class BulkLoaderTests(SerializationTestCase):
+    def test_levels(self):
+        owner = Owner(pk=1, email='tom@example.com')
+        vehicle = Vehicle(pk=1, owner_id=1, licence='DJANGO42',
+                          date_of_manufacture=datetime.date(day=6, month=6, year=2005))
+        loader = BulkLoader()
+        tables = loader.get_tables([vehicle, owner, TreeNode(pk=1, name='root')])
+        self.assertEquals(loader.get_levels(tables), [[Owner, TreeNode], [Vehicle]])
+
+    def test_cyclic_foreign_keys(self):
+        objs = [
+            Player(pk=1, name='Alice', team_id=1),
+            Player(pk=2, name='Bob', team_id=1),
+            Team(pk=1, name='Reds', captain_id=2),
+        ]
+        loader = BulkLoader(threads=4)
+        self.assertEquals(loader.get_levels(loader.get_tables(objs)), [[Team], [Player]])
+        self.assertFalse(loader.is_concurrent())
+        # The teams, the players, then the captains.
+        with self.assertNumQueries(3):
+            loader.load(objs)
+        self.assertEquals(Team.objects.get().captain.name, u'Bob')
+        self.assertEquals([player.team.name for player in Player.objects.all()],
+                          [u'Reds', u'Reds'])
+
+    def test_validate_references(self):
+        Owner.objects.create(email='tom@example.com')
+        date = datetime.date(day=6, month=6, year=2005)
+        objs = [
+            Owner(pk=2, email='jane@example.com'),
+            Vehicle(pk=1, owner_id=1, licence='A', date_of_manufacture=date),
+            Vehicle(pk=2, owner_id=2, licence='B', date_of_manufacture=date),
+            Vehicle(pk=3, owner_id=7, licence='C', date_of_manufacture=date),
+            DeserializedObject(Book(pk=1, title='Cooking with gas', in_stock=True),
+                               {'authors': [5, 6]}),
+        ]
+        # One query for each related model, and nothing is written.
+        with self.assertNumQueries(2):
+            try:
+                BulkLoader(validate=True).load(objs)
+            except ValidationError, exc:
+                messages = exc.messages
+            else:
+                self.fail('ValidationError not raised')
+        self.assertEquals(messages, [
+            u"serializers.vehicle(pk=3): serializers.owner with id 7 does not exist.",
+            u"serializers.book(pk=1): serializers.author with id 5 does not exist.",
+            u"serializers.book(pk=1): serializers.author with id 6 does not exist.",
+        ])
+        self.assertEquals(Owner.objects.count(), 1)
+        self.assertEquals(Vehicle.objects.count(), 0)
+
+        BulkLoader(validate=True).load(objs[:3])
+        self.assertEquals(Vehicle.objects.count(), 2)
+
+    def test_self_referential_foreign_keys(self):
+        objs = [
+            TreeNode(pk=1, name='child', parent_id=2),
+            TreeNode(pk=2, name='root', parent_id=None),
+            TreeNode(pk=3, name='loop', parent_id=3),
+        ]
+        # The rows are inserted, then the foreign keys are updated.
+        with self.assertNumQueries(2):
+            BulkLoader().load(objs)
+        self.assertEquals([obj.parent_id for obj in objs], [2, None, 3])
+        self.assertEquals(
+            list(TreeNode.objects.order_by('pk').values_list('pk', 'parent')),
+            [(1, 2), (2, None), (3, 3)]
+        )
+
+    def test_self_referential_foreign_key_without_pk(self):
+        root = TreeNode(pk=5, name='root')
+        child = TreeNode(name='child', parent_id=5)
+        self.assertEquals(BulkLoader().load([root, child]), 2)
+        self.assertEquals(child.parent_id, 5)
+        self.assertEquals(
+            list(TreeNode.objects.order_by('pk').values_list('name', 'parent')),
+            [(u'root', None), (u'child', 5)]
+        )
+
+    def test_updates_are_batched(self):
+        objs = [TreeNode(pk=pk, name='%d' % pk, parent_id=pk + 1) for pk in range(1, 11)]
+        objs.append(TreeNode(pk=11, name='11'))
+        # Three inserts and two updates.
+        with self.assertNumQueries(5):
+            BulkLoader(batch_size=5).load(objs)
+        self.assertEquals(
+            list(TreeNode.objects.order_by('pk').values_list('parent', flat=True)),
+            range(2, 12) + [None]
+        )
+
+
 class ComplexModel(models.Model):
     field1 = models.CharField(max_length=10)
     field2 = models.CharField(max_length=10)
@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 from django.utils.datastructures import SortedDict
+from django.utils.importlib import import_module
 from django.utils.timezone import is_aware
 
-import csv
+import cStringIO
+import collections
 import datetime
 import decimal
 import inspect
+import mmap
+import os
+import pkgutil
+import stat
+import struct
+import threading
 import types
+import zlib
 from django.utils import simplejson as json
 
 
@@ -33,18 +42,398 @@ class SortedDictWithMetadata(SortedDict, DictWithMetadata):
     pass
 
 
-try:
+class RowSchema(object):
+    """
+    The keys and serializer fields of a serialized object.
+
+    Every object converted with the same set of fields shares a single
+    schema, rather than each row keeping its own copy.
+    """
+    __slots__ = ('keys', 'fields', 'creation_order')
+
+    def __init__(self, keys, fields):
+        self.keys = tuple(keys)
+        self.fields = dict(zip(self.keys, fields))
+        self.creation_order = tuple(sorted(self.keys,
+            key=lambda key: self.fields[key].creation_counter))
+
+    def __getstate__(self):
+        return (self.keys, self.fields, self.creation_order)
+
+    def __setstate__(self, state):
+        self.keys, self.fields, self.creation_order = state
+
+
+class Row(dict):
+    """
+    A compact dict of serialized values, which gets the serializer field
+    for each key from a shared `RowSchema`.
+    """
+    __slots__ = ('schema',)
+
+    def __init__(self, schema=None, *args, **kwargs):
+        super(Row, self).__init__(*args, **kwargs)
+        self.schema = schema
+
+    def __reduce__(self):
+        # The schema is restored after the row is created, as it may refer
+        # back to the row through its fields.
+        return (self.__class__, (), self.__getstate__(), None, iter(self.items()))
+
+    def __getstate__(self):
+        return self.schema
+
+    def __setstate__(self, state):
+        self.schema = state
+
+    @property
+    def fields(self):
+        if self.schema is None:
+            return {}
+        return self.schema.fields
+
+
+class SortedRow(Row):
+    """
+    A `Row` that iterates over its keys in the order given by its schema.
+    Any keys that are added once the schema is set come last, in the order
+    they were added.
+    """
+    __slots__ = ('extra_keys',)
+
+    def __init__(self, schema=None, *args, **kwargs):
+        super(SortedRow, self).__init__(schema)
+        self.extra_keys = None
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if (self.schema is not None and key not in self.schema.fields and
+                key not in self):
+            if self.extra_keys is None:
+                self.extra_keys = []
+            if key not in self.extra_keys:  # Already restored by a copy
+                self.extra_keys.append(key)
+        super(SortedRow, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(SortedRow, self).__delitem__(key)
+        if self.extra_keys and key in self.extra_keys:
+            self.extra_keys.remove(key)
+
+    def __iter__(self):
+        if self.schema is None:
+            return super(SortedRow, self).__iter__()
+        keys = [key for key in self.schema.keys if key in self]
+        if len(keys) != len(self):
+            keys.extend(self.extra_keys or ())
+        if len(keys) != len(self):
+            # Keys that were added before the schema was set.
+            known = set(keys)
+            keys.extend(key for key in super(SortedRow, self).__iter__()
+                        if key not in known)
+        return iter(keys)
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                other = [(key, other[key]) for key in other.keys()]
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super(SortedRow, self).pop(key, *args)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = list(self)[-1]
+        return key, self.pop(key)
+
+    def clear(self):
+        super(SortedRow, self).clear()
+        self.extra_keys = None
+
+    def copy(self):
+        return self.__class__(self.schema, self.items())
+
+    def __getstate__(self):
+        return (self.schema, self.extra_keys and self.extra_keys[:])
+
+    def __setstate__(self, state):
+        self.schema, self.extra_keys = state
+
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%r: %r' % item for item in self.iteritems()])
+
+
+class DeferredValue(object):
+    """
+    A placeholder for a value that is looked up later by a `BatchLoader`,
+    together with the other values requested from the same loader.
+    """
+    created = 0  # Lets serializers skip looking for placeholders if none exist
+
+    def __init__(self, loader=None, key=None, parent=None, callback=None):
+        self.loader = loader
+        self.key = key
+        self.parent = parent
+        self.callback = callback
+        DeferredValue.created += 1
+
+    def then(self, callback):
+        """
+        Returns a placeholder for the result of calling `callback` with
+        this value, once it has been loaded.
+        """
+        return DeferredValue(parent=self, callback=callback)
+
+    def get_loader(self):
+        if self.parent is not None:
+            return self.parent.get_loader()
+        return self.loader
+
+    def get(self):
+        if self.parent is not None:
+            return self.callback(self.parent.get())
+        return self.loader.get(self.key)
+
+
+class _BatchLoaderState(threading.local):
+    """
+    The keys requested from a `BatchLoader` and the values loaded, kept
+    separately for each thread.
+    """
+    def __init__(self):
+        self.pending = []
+        self.values = {}
+
+
+class BatchLoader(object):
+    """
+    Loads values by key, deferring each lookup so that all the values
+    requested while serializing a chunk of objects are loaded together.
+
+    Either `batch_function` is called with a list of keys, and must return
+    a list of values in the same order, or `function` is called with each
+    key in turn, using a pool of `threads` threads.  Loaded values are
+    discarded once they have been substituted, unless `cache` is set, in
+    which case they are kept by key for the lifetime of the loader.
+
+    The requested keys and loaded values are kept separately for each
+    thread, so a loader may be shared between threads.
+    """
+    def __init__(self, batch_function=None, function=None, threads=4, cache=False):
+        if (batch_function is None) == (function is None):
+            raise ValueError("Either 'batch_function' or 'function' is required")
+        self.batch_function = batch_function
+        self.function = function
+        self.threads = threads
+        self.cache = cache
+        self.state = _BatchLoaderState()
+
+    def load(self, key):
+        """
+        Returns a `DeferredValue` for the value with the given key.
+        """
+        if key not in self.state.values:
+            self.state.pending.append(key)
+        return DeferredValue(self, key)
+
+    def dispatch(self):
+        """
+        Load all the values that have been requested but not yet loaded.
+        """
+        keys = list(SortedDict.fromkeys(
+            [key for key in self.state.pending if key not in self.state.values]))
+        self.state.pending = []
+        if not keys:
+            return
+        if self.batch_function is not None:
+            values = self.batch_function(keys)
+        elif len(keys) == 1 or self.threads <= 1:
+            values = map(self.function, keys)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.threads, len(keys)))
+            try:
+                values = pool.map(self.function, keys)
+            finally:
+                pool.close()
+                pool.join()
+        self.state.values.update(zip(keys, values))
+
+    def get(self, key):
+        if key in self.state.values:
+            return self.state.values[key]
+        self.state.pending.append(key)
+        self.dispatch()
+        value = self.state.values[key]
+        self.clear()
+        return value
+
+    def clear(self):
+        """
+        Discard the loaded values, unless they are being cached.
+        """
+        if not self.cache:
+            self.state.values = {}
+
+
+def resolve_deferred(data):
+    """
+    Replace any `DeferredValue` placeholders within the given dicts and
+    lists, in place, loading the values from each loader in one go.
+    """
+    found = []
+    todo = [data]
+    while todo:
+        item = todo.pop()
+        if isinstance(item, dict):
+            children = item.iteritems()
+        elif isinstance(item, list):
+            children = enumerate(item)
+        else:
+            continue
+        for key, value in children:
+            if isinstance(value, DeferredValue):
+                found.append((item, key, value))
+            elif isinstance(value, (dict, list)):
+                todo.append(value)
+
+    loaders = SortedDict()
+    for container, key, deferred in found:
+        loaders[deferred.get_loader()] = None
+    for loader in loaders:
+        loader.dispatch()
+    for container, key, deferred in found:
+        container[key] = deferred.get()
+    for loader in loaders:
+        loader.clear()
+
+
+_imported = {}
+
+
+def import_by_path(dotted_path):
+    """
+    Import and return the object at a dotted path,
+    eg. 'serializers.renderers.JSONRenderer'.
+    """
+    try:
+        return _imported[dotted_path]
+    except KeyError:
+        module_path, name = dotted_path.rsplit('.', 1)
+        obj = _imported[dotted_path] = getattr(import_module(module_path), name)
+        return obj
+
+
+_optional_modules = {}
+
+
+def optional_import(name):
+    """
+    Import and return a module, or return None if it is not installed.
+    """
+    try:
+        return _optional_modules[name]
+    except KeyError:
+        try:
+            module = import_module(name)
+        except ImportError:
+            module = None
+        _optional_modules[name] = module
+        return module
+
+
+def is_installed(name):
+    """
+    True if the named top-level module can be imported, without importing it.
+    """
+    if name in _optional_modules:
+        return _optional_modules[name] is not None
+    return pkgutil.find_loader(name) is not None
+
+
+class ClassRegistry(dict):
+    """
+    A dict of renderer or parser classes, keyed by format.
+
+    Classes may be given as dotted paths, in which case they are only
+    imported the first time that format is used.
+    """
+    def __getitem__(self, key):
+        value = super(ClassRegistry, self).__getitem__(key)
+        if isinstance(value, basestring):
+            value = import_by_path(value)
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+_safe_dumper = None
+
+
+def get_safe_dumper():
+    """
+    Returns the yaml Dumper class used by `YAMLRenderer`.
+
+    The class is created on first use, so that yaml is only imported
+    when it is actually needed.
+    """
+    global _safe_dumper
+    if _safe_dumper is not None:
+        return _safe_dumper
+
     import yaml
-except ImportError:
-    SafeDumper = None
-else:
+
     # Adapted from http://pyyaml.org/attachment/ticket/161/use_ordered_dict.py
     class SafeDumper(yaml.SafeDumper):
         """
         Handles decimals as strings.
         Handles SortedDicts as usual dicts, but preserves field order, rather
         than the usual behaviour of sorting the keys.
+        Never uses anchors and aliases, as values may be shared between
+        objects, eg. cached natural keys.
         """
+        def ignore_aliases(self, data):
+            return True
+
         def represent_decimal(self, data):
             return self.represent_scalar('tag:yaml.org,2002:str', str(data))
 
@@ -77,9 +466,16 @@ else:
             yaml.representer.SafeRepresenter.represent_dict)
     SafeDumper.add_representer(SortedDictWithMetadata,
             yaml.representer.SafeRepresenter.represent_dict)
+    SafeDumper.add_representer(Row,
+            yaml.representer.SafeRepresenter.represent_dict)
+    SafeDumper.add_representer(SortedRow,
+            yaml.representer.SafeRepresenter.represent_dict)
     SafeDumper.add_representer(types.GeneratorType,
             yaml.representer.SafeRepresenter.represent_list)
 
+    _safe_dumper = SafeDumper
+    return _safe_dumper
+
 
 class DjangoJSONEncoder(json.JSONEncoder):
     """
@@ -110,7 +506,430 @@ class DjangoJSONEncoder(json.JSONEncoder):
         return super(DjangoJSONEncoder, self).default(o)
 
 
-class DictWriter(csv.DictWriter):
+class MessagePackEncoder(object):
+    """
+    A pure python MessagePack encoder, used if the `msgpack` package is not
+    installed.
+
+    Date/time and decimal types are encoded as strings, in the same way as
+    DjangoJSONEncoder.  Strings are encoded using the str family of types,
+    but without `str8`, matching the output of `msgpack` with
+    `use_bin_type=False`.  Mappings are encoded in iteration order, so
+    field order is preserved.
+    """
+    def __init__(self):
+        self.json_encoder = DjangoJSONEncoder()
+
+    def default(self, o):
+        return self.json_encoder.default(o)
+
+    def encode(self, obj):
+        chunks = []
+        self._encode(obj, chunks.append)
+        return ''.join(chunks)
+
+    def _encode(self, obj, write):
+        if obj is None:
+            write('\xc0')
+        elif obj is True:
+            write('\xc3')
+        elif obj is False:
+            write('\xc2')
+        elif isinstance(obj, (int, long)):
+            write(self._encode_int(obj))
+        elif isinstance(obj, float):
+            write(struct.pack('>Bd', 0xcb, obj))
+        elif isinstance(obj, basestring):
+            if isinstance(obj, unicode):
+                obj = obj.encode('utf-8')
+            write(self._encode_header(len(obj), 0xa0, 31, None, 0xda, 0xdb))
+            write(obj)
+        elif isinstance(obj, dict):
+            write(self._encode_header(len(obj), 0x80, 15, None, 0xde, 0xdf))
+            for key, value in obj.items():
+                self._encode(key, write)
+                self._encode(value, write)
+        elif isinstance(obj, (list, tuple)):
+            write(self._encode_header(len(obj), 0x90, 15, None, 0xdc, 0xdd))
+            for item in obj:
+                self._encode(item, write)
+        else:
+            self._encode(self.default(obj), write)
+
+    def _encode_header(self, length, fixed, fixed_max, code8, code16, code32):
+        if length <= fixed_max:
+            return chr(fixed | length)
+        elif code8 is not None and length <= 0xff:
+            return struct.pack('>BB', code8, length)
+        elif length <= 0xffff:
+            return struct.pack('>BH', code16, length)
+        elif length <= 0xffffffff:
+            return struct.pack('>BI', code32, length)
+        raise ValueError('Object too large to encode as MessagePack')
+
+    def _encode_int(self, value):
+        if 0 <= value <= 0x7f:
+            return chr(value)
+        elif -32 <= value < 0:
+            return struct.pack('>b', value)
+        elif 0 < value <= 0xff:
+            return struct.pack('>BB', 0xcc, value)
+        elif 0 < value <= 0xffff:
+            return struct.pack('>BH', 0xcd, value)
+        elif 0 < value <= 0xffffffff:
+            return struct.pack('>BI', 0xce, value)
+        elif 0 < value <= 0xffffffffffffffff:
+            return struct.pack('>BQ', 0xcf, value)
+        elif -0x80 <= value < 0:
+            return struct.pack('>Bb', 0xd0, value)
+        elif -0x8000 <= value < 0:
+            return struct.pack('>Bh', 0xd1, value)
+        elif -0x80000000 <= value < 0:
+            return struct.pack('>Bi', 0xd2, value)
+        elif -0x8000000000000000 <= value < 0:
+            return struct.pack('>Bq', 0xd3, value)
+        raise ValueError('Integer too large to encode as MessagePack')
+
+
+class MessagePackDecoder(object):
+    """
+    A pure python MessagePack decoder, used if the `msgpack` package is not
+    installed.
+
+    Iterating over the decoder yields each object in the stream in turn,
+    reading the stream in blocks of `block_size` bytes.  Extension types
+    are not supported.
+    """
+    formats = {
+        0xca: ('>f', 4), 0xcb: ('>d', 8),
+        0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+        0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+    }
+    lengths = {
+        0xc4: ('>B', 1), 0xc5: ('>H', 2), 0xc6: ('>I', 4),  # bin
+        0xd9: ('>B', 1), 0xda: ('>H', 2), 0xdb: ('>I', 4),  # str
+        0xdc: ('>H', 2), 0xdd: ('>I', 4),  # array
+        0xde: ('>H', 2), 0xdf: ('>I', 4),  # map
+    }
+
+    def __init__(self, stream, block_size=65536):
+        self.stream = stream
+        self.block_size = block_size
+        self.buffer = ''
+        self.position = 0
+
+    def __iter__(self):
+        while self._fill(1):
+            yield self._decode()
+
+    def _fill(self, size):
+        """
+        Ensure at least `size` unread bytes are buffered, returning False if
+        the stream ends first.
+        """
+        available = len(self.buffer) - self.position
+        if available >= size:
+            return True
+        chunks = [self.buffer[self.position:]]
+        while available < size:
+            chunk = self.stream.read(max(size - available, self.block_size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        self.buffer = ''.join(chunks)
+        self.position = 0
+        return available >= size
+
+    def _read(self, size):
+        if not self._fill(size):
+            raise ValueError('Unexpected end of MessagePack data')
+        start = self.position
+        self.position += size
+        return self.buffer[start:self.position]
+
+    def _unpack(self, fmt, size):
+        return struct.unpack(fmt, self._read(size))[0]
+
+    def _decode(self):
+        code = ord(self._read(1))
+        if code <= 0x7f:
+            return code
+        elif code >= 0xe0:
+            return code - 0x100
+        elif code <= 0x8f:
+            return self._decode_map(code & 0x0f)
+        elif code <= 0x9f:
+            return self._decode_array(code & 0x0f)
+        elif code <= 0xbf:
+            return self._read(code & 0x1f).decode('utf-8')
+        elif code == 0xc0:
+            return None
+        elif code == 0xc2:
+            return False
+        elif code == 0xc3:
+            return True
+        elif code in self.formats:
+            return self._unpack(*self.formats[code])
+        elif code in self.lengths:
+            length = self._unpack(*self.lengths[code])
+            if code <= 0xc6:
+                return self._read(length)
+            elif code <= 0xdb:
+                return self._read(length).decode('utf-8')
+            elif code <= 0xdd:
+                return self._decode_array(length)
+            return self._decode_map(length)
+        raise ValueError('Unsupported MessagePack type 0x%02x' % code)
+
+    def _decode_array(self, length):
+        return [self._decode() for index in xrange(length)]
+
+    def _decode_map(self, length):
+        ret = {}
+        for index in xrange(length):
+            key = self._decode()
+            ret[key] = self._decode()
+        return ret
+
+
+COMPRESSION_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def is_compressed(stream):
+    """
+    True if a seekable stream starts with the gzip magic number.
+    The stream position is left unchanged.
+
+    Deflate (zlib) headers are not detected, as they are too short to tell
+    apart from ordinary text, eg. the CSV header "H,W".
+    """
+    try:
+        position = stream.tell()
+        header = stream.read(2)
+        stream.seek(position)
+    except (AttributeError, IOError, ValueError):
+        return False
+    if len(header) < 2:
+        return False
+    return header == '\x1f\x8b'
+
+
+class CompressedWriter(object):
+    """
+    A file-like object that compresses data as it is written, in either
+    'gzip' or 'deflate' (zlib) format, and writes it to `stream`.
+
+    Closing the writer flushes the remaining compressed data, but does not
+    close the underlying stream.
+    """
+    def __init__(self, stream, method='gzip', level=6):
+        if method is True:
+            method = 'gzip'
+        try:
+            wbits = COMPRESSION_WBITS[method]
+        except KeyError:
+            raise ValueError("Unknown compression method '%s'" % method)
+        self.stream = stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        data = self.compressor.compress(data)
+        if data:
+            self.stream.write(data)
+
+    def flush(self):
+        pass  # Flushing mid-stream would reduce the compression ratio.
+
+    def close(self):
+        self.stream.write(self.compressor.flush())
+
+
+def _gzip_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS['gzip'])
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    A file-like object that splits the data written to it into blocks of
+    `block_size` bytes, and compresses the blocks on a pool of `threads`
+    threads.
+
+    Each block is written to `stream` as a separate gzip member, in order,
+    so the output is a standard multi-member gzip file.  zlib releases the
+    GIL while compressing, so the blocks are compressed concurrently.
+    """
+    def __init__(self, stream, threads=4, block_size=1024 * 1024, level=6):
+        self.stream = stream
+        self.block_size = block_size
+        self.level = level
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(threads)
+        self.max_pending = threads * 2
+        self.pending = collections.deque()
+        self.chunks = []
+        self.size = 0
+        self.blocks = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        block = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.blocks += 1
+        self.pending.append(self.pool.apply_async(_gzip_block, (block, self.level)))
+        # Bound memory use by waiting for the oldest blocks to complete.
+        while len(self.pending) >= self.max_pending:
+            self.stream.write(self.pending.popleft().get())
+
+    def flush(self):
+        pass  # Blocks are only written once they are full.
+
+    def close(self):
+        try:
+            if self.chunks or not self.blocks:
+                self._submit()
+            while self.pending:
+                self.stream.write(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class DecompressedReader(object):
+    """
+    A read-only file-like object that decompresses gzip or deflate (zlib)
+    data from `stream` incrementally, `block_size` bytes at a time.
+
+    Multi-member gzip data, as written by parallel compressors, is read
+    as a single stream.
+    """
+    def __init__(self, stream, block_size=65536):
+        self.stream = stream
+        self.block_size = block_size
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.position = 0
+        self.finished = False
+
+    def _fill(self):
+        """
+        Decompress the next block, returning False at the end of the stream.
+        """
+        data = self.stream.read(self.block_size)
+        if not data:
+            self.finished = True
+            return False
+        chunks = [self.buffer[self.position:]]
+        while data:
+            try:
+                chunks.append(self.decompressor.decompress(data))
+            except zlib.error as e:
+                raise IOError('Invalid compressed data: %s' % e)
+            data = self.decompressor.unused_data
+            if data:
+                # Start of the next gzip member
+                self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.buffer = ''.join(chunks)
+        self.position = 0
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and not self.finished:
+            self._fill()
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = self.position + size
+        ret = self.buffer[self.position:end]
+        self.position += len(ret)
+        return ret
+
+    def readline(self):
+        while True:
+            end = self.buffer.find('\n', self.position)
+            if end >= 0 or self.finished:
+                break
+            self._fill()
+        if end < 0:
+            end = len(self.buffer)
+        else:
+            end += 1
+        ret = self.buffer[self.position:end]
+        self.position = end
+        return ret
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def map_file(source):
+    """
+    Memory-map a file, given either its path or an open file object.
+
+    Returns a read-only file-like object that reads directly from the
+    mapping, starting at the file's current position, so the contents are
+    not also copied onto the heap.  Anything other than a regular,
+    non-empty file is returned unchanged.
+    """
+    if isinstance(source, basestring):
+        with open(source, 'rb') as source:
+            return map_file(source)
+
+    try:
+        info = os.fstat(source.fileno())
+        position = source.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return source
+    if not stat.S_ISREG(info.st_mode) or not info.st_size:
+        return source
+
+    mapping = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    stream = cStringIO.StringIO(mapping)
+    stream.seek(position)
+    return stream
+
+
+def input_stream(stream_or_string):
+    """
+    Returns a stream to read the input for deserialization from.
+
+    Strings, buffers, memoryviews and mmap objects are read in place,
+    without being copied, and regular files are memory-mapped.
+    """
+    if isinstance(stream_or_string, unicode):
+        stream_or_string = stream_or_string.encode('utf-8')
+    elif isinstance(stream_or_string, bytearray):
+        # A memoryview prevents the bytearray being resized while in use.
+        stream_or_string = memoryview(stream_or_string)
+
+    if isinstance(stream_or_string, (str, buffer, memoryview, mmap.mmap)):
+        return cStringIO.StringIO(stream_or_string)
+    elif isinstance(stream_or_string, file):
+        return map_file(stream_or_string)
+    return stream_or_string
+
+
+class DictWriter(object):
     """
     >>> from cStringIO import StringIO
     >>> f = StringIO()
@@ -130,6 +949,7 @@ class DictWriter(csv.DictWriter):
         self.fieldnames = fieldnames
         self.encoding = encoding
         self.restval = restval
+        import csv
         self.writer = csv.DictWriter(csvfile, fieldnames, restval, extrasaction, dialect, *args, **kwds)
 
     def _stringify(self, s, encoding):